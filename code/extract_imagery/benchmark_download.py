@@ -0,0 +1,86 @@
+import os
+import sys
+import time
+import hashlib
+import tempfile
+import threading
+import http.server
+
+from sources import download_ranges, HTTPTransport
+from serve_exports import ExportHandler
+
+# Usage: python benchmark_download.py [size_mb] [latency_ms] [chunk_mb]
+# Serves a random file from a local HTTP server that answers Range requests after latency_ms,
+# standing in for Google Drive, and times download_ranges with 1 to 8 ranges in flight.
+size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+latency_ms = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+chunk_mb = int(sys.argv[3]) if len(sys.argv) > 3 else 16
+
+
+class FailingTransport(HTTPTransport):
+    # fails every request after the first n, to interrupt a download
+    def __init__(self, n):
+        self.n = n
+        self.lock = threading.Lock()
+
+    def __call__(self, url, byte_begin, byte_end):
+        with self.lock:
+            self.n -= 1
+            if self.n < 0:
+                raise IOError("interrupted")
+        return super().__call__(url, byte_begin, byte_end)
+
+
+def main():
+    tempdir = tempfile.mkdtemp()
+    served = os.path.join(tempdir, "served.tfrecord")
+    with open(served, "wb") as fh:
+        fh.write(os.urandom(size_mb * 2 ** 20))
+    with open(served, "rb") as fh:
+        md5 = hashlib.md5(fh.read()).hexdigest()
+    ExportHandler.directory = tempdir
+    ExportHandler.latency_ms = latency_ms
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), ExportHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "http://127.0.0.1:{}/served.tfrecord".format(server.server_port)
+    outpath = os.path.join(tempdir, "downloaded.tfrecord")
+    total_size = size_mb * 2 ** 20
+    chunk_size = chunk_mb * 2 ** 20
+
+    print("{} MB in {} MB ranges, {} ms per request".format(size_mb, chunk_mb, latency_ms))
+    for workers in [1, 2, 4, 8]:
+        start = time.time()
+        download_ranges(url, outpath, total_size, HTTPTransport(), md5, chunk_size, workers)
+        seconds = time.time() - start
+        print("{:>2} ranges in flight {:>8.2f} s {:>10.1f} MB/s".format(workers, seconds, size_mb / seconds))
+        os.unlink(outpath)
+
+    # interrupt a download halfway, then resume it from the partial file
+    n_chunks = -(-total_size // chunk_size)
+    try:
+        download_ranges(url, outpath, total_size, FailingTransport(n_chunks // 2), md5, chunk_size, 1)
+    except IOError:
+        pass
+    start = time.time()
+    download_ranges(url, outpath, total_size, HTTPTransport(), md5, chunk_size, 4)
+    print("resumed after {} of {} ranges {:>6.2f} s, MD5 verified".format(n_chunks // 2, n_chunks, time.time() - start))
+    os.unlink(outpath)
+
+    # an empty file and one of a whole number of ranges have no partial last range
+    for size in [0, 2 * chunk_size]:
+        with open(served, "wb") as fh:
+            fh.write(os.urandom(size))
+        with open(served, "rb") as fh:
+            md5 = hashlib.md5(fh.read()).hexdigest()
+        download_ranges(url, outpath, size, HTTPTransport(), md5, chunk_size, 4)
+        if os.path.getsize(outpath) != size or os.path.exists(outpath + ".part.json"):
+            sys.exit("download of {} bytes in {} byte ranges failed".format(size, chunk_size))
+        print("{} bytes in {} byte ranges, MD5 verified".format(size, chunk_size))
+        os.unlink(outpath)
+    os.unlink(served)
+    os.rmdir(tempdir)
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
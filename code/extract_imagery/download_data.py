@@ -1,7 +1,10 @@
 import os
 import sys
+import time
+import queue
 import tables
 import logging
+import threading
 
 import numpy as np
 import pandas as pd
@@ -11,7 +14,8 @@ tf.config.threading.set_inter_op_parallelism_threads(1)
 
 tf.compat.v1.disable_eager_execution()
 
-from google_drive_utils import GDFolderDownloader
+from sources import open_source
+from ingest_ledger import IngestLedger
 from params import *
 
 # ログ設定：実行中のスクリプト名をLogger名に使っている
@@ -34,6 +38,30 @@ if mode not in ["large", "small", "mw"]:
 # HDF5出力ファイルのパスを設定
 path = f"{ROOT}/data/{mode}_images_all_years_raw.h5"
 
+# 同時ダウンロード数、パースのワーカー数、一時フォルダに置くファイル数の上限
+n_downloads = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+n_parsers = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+max_files = int(sys.argv[4]) if len(sys.argv) > 4 else n_downloads + n_parsers
+if min(n_downloads, n_parsers, max_files) < 1:
+    raise Exception("n_downloads, n_parsers and max_files must be positive")
+# 一度にパースする画像数と、パース済みで書き込み待ちのバッチ数の上限（ファイルごと）
+PARSE_BATCH = 32
+QUEUE_BATCHES = 4
+
+# HDF5の構成：table は全年の画像を一つのレコードに持つテーブル、by_year は年ごとに
+# 圧縮した配列（prep_data.py が年を選んで読める、split_years.py と同じ構成）
+layout = sys.argv[5] if len(sys.argv) > 5 else "table"
+if layout not in ["table", "by_year"]:
+    raise Exception("Layout must be 'table' or 'by_year'")
+if layout == "by_year":
+    path = f"{ROOT}/data/{mode}_images_all_years_by_year.h5"
+# by_year の一つのチャンクに入れる画像数と圧縮方法
+CHUNK_IMAGES = 16
+FILTERS = tables.Filters(complevel=5, complib="blosc:lz4", shuffle=True)
+
+# 画像ファイルの取得元：drive（Google Drive）、serve_exports.py の http(s):// URL、またはローカルのディレクトリ
+source = sys.argv[6] if len(sys.argv) > 6 else "drive"
+
 
 # モードによってGoogle DriveのディレクトリID、画像サイズ、チャンネル名を設定
 if mode == "small":
@@ -106,87 +134,225 @@ def main():
     # HDF5ファイルの作成または追記モードで開く
     h5_open_mode = "w" if not os.path.exists(path) else "a"
     h5_file = tables.open_file(path, mode=h5_open_mode)
-    if "/data" not in h5_file:
-        h5_file.create_table("/", "data", IMGData)
-    table = h5_file.get_node("/data")
+    if layout == "by_year":
+        table = ByYearArrays(h5_file)
+    else:
+        if "/data" not in h5_file:
+            h5_file.create_table("/", "data", IMGData)
+        table = h5_file.get_node("/data")
     
-    # すでに処理済みのファイルを記録するテキストファイル
-    processed_paths_file = f"{ROOT}/outputs/processed_paths_{mode}.txt"
-    if not os.path.exists(processed_paths_file):
-        with open(processed_paths_file, "w") as fh:
-            pass
-
-    # Google Drive から tfrecord ファイル一覧を取得し、フィルタ・ソート
-    GD = GDFolderDownloader(
-        root_dir_id, 
-        tempdir, os.getcwd() + "/client_secrets.json",
-        processed_paths_file)
-    GD.file_list = filter(lambda x: ".tfrecord" in x["title"], GD.file_list)
+    # 取り込みの記録（ファイルごとの状態と時間、画像ごとの出所）。以前のテキストファイルがあれば引き継ぐ
+    outfh_path = f"{ROOT}/outputs/valid_imgs_{mode}.txt"
+    ledger = IngestLedger(f"{ROOT}/outputs/ingest_{mode}.sqlite")
+    ledger.import_text_files(f"{ROOT}/outputs/processed_paths_{mode}.txt", outfh_path)
+
+    # 取得元から tfrecord ファイル一覧を取得し、フィルタ・ソート
+    src = open_source(source, root_dir_id, tempdir, os.getcwd() + "/client_secrets.json")
+    all_files = filter(lambda x: ".tfrecord" in x["title"], src.list())
 
     key = lambda x: int(x["title"].split("-")[-1].replace(".tfrecord",""))
-    GD.file_list = sorted(GD.file_list, key=key)
+    all_files = sorted(all_files, key=key)
+    ledger.list_files(all_files)
+    file_list = ledger.pending(all_files)
+
+    # 前回の実行が途中で止まった場合は、記録された画像より後の行を HDF5 から切り捨てて続きから始める
+    ix = ledger.n_images()
+    if table.nrows < ix:
+        raise Exception("{} has {} rows but the ledger records {} images".format(path, table.nrows, ix))
+    if table.nrows > ix:
+        LOG.info("Dropping {} rows of an unfinished file".format(table.nrows - ix))
+        table.truncate(ix)
 
     # 各画像ファイルをダウンロードして処理
-    ix = 0
+    # ダウンロード、パース、HDF5への書き込みを並行して行う。書き込みはこのスレッドだけが行い、
+    # ファイルの順番も逐次処理と同じなので img_id は変わらない
     invalid_data = 0
-    outfh_path = f"{ROOT}/outputs/valid_imgs_{mode}.txt"
-    out_fh = open(outfh_path, "w" if not os.path.exists(outfh_path) else "a")
 
-    LOG.info("Total Images to download: {}".format(len(GD.file_list)))
+    LOG.info("Total Images to download: {} ({} already parsed)".format(
+        len(file_list), len(all_files) - len(file_list)))
+
+    pipeline = Pipeline(src, tempdir, file_list, ledger)
+    threads = [threading.Thread(target=pipeline.download_worker, daemon=True) for _ in range(n_downloads)]
+    threads += [threading.Thread(target=pipeline.parse_worker, daemon=True) for _ in range(n_parsers)]
+    for thread in threads:
+        thread.start()
 
     total_imgs = 0
-    for fpath in GD.file_iterator():
-        img_num = 0
-        if fpath is None:
-            LOG.info("File exists - Delete it to download again...")
+    start = time.time()
+    for k, fm in enumerate(file_list):
+        first = ix
+        provenance = []
+        while True:
+            item = pipeline.results[k].get()
+            if isinstance(item, (Exception, dict)):
+                break
+            imgs, lat, lng, urban_share, img_num = item
+            provenance.append((np.arange(ix + 1, ix + len(img_num) + 1), img_num, lat, lng, urban_share))
+
+            # バッチごとに構造化配列を作ってまとめて追記
+            rows = np.empty(len(img_num), dtype=table.dtype)
+            for j, y in enumerate(YEARS):
+                rows["img{}".format(y)] = imgs[:, j]
+            rows["urban_share"] = urban_share
+            rows["lat"] = lat
+            rows["lng"] = lng
+            rows["img_id"] = np.arange(ix + 1, ix + len(img_num) + 1)
+            table.append(rows)
+            ix += len(img_num)
+
+        if isinstance(item, Exception):
+            # 失敗したファイルの行は取り消し、次回の実行でやり直す
+            LOG.warning("Failed: {} ({!r})".format(fm["title"], item))
+            table.truncate(first)
+            ix = first
+            ledger.set_state(fm["title"], "failed", repr(item))
             continue
-
-        it = tfr_data_pipeline(fpath, IMG_ROWS_RAW, IMG_COLS_RAW)
-
-        with tf.compat.v1.Session() as sess:
-            while True:
-                try:
-                    imgs, lat, lng, urban = sess.run(it)
-                    img_num += 1
-
-                    urban[np.isnan(urban)] = 0
-                    if np.mean(urban) < 0.1:
-                        continue  # 都市化割合が低い画像はスキップ
-
-                    lat = lat[IMG_ROWS_RAW//2, IMG_COLS_RAW//2]
-                    lng = lng[IMG_ROWS_RAW//2, IMG_COLS_RAW//2]
-                    ix += 1
-                    out_fh.write("{},{},{},{},{},{}\n".format(
-                        fpath, img_num, ix, lat, lng, np.nanmean(urban)))
-
-                    for y in YEARS:
-                        table.row["img{}".format(y)] = imgs[y]
-                    table.row["urban_share"] = np.nanmean(urban)
-                    table.row["lat"] = lat
-                    table.row["lng"] = lng
-                    table.row["img_id"] = ix
-
-                    table.row.append()
-                    total_imgs += 1
-
-                except tf.errors.OutOfRangeError:
-                    break
-                except tf.errors.DataLossError:
-                    invalid_data += 1
-                    break
-
-        LOG.info("Wrote: {} images".format(total_imgs))
-        with open(processed_paths_file, "a") as fh:
-            fh.write(fpath + "\n")
-        os.unlink(fpath)  # 一時ファイル削除
-
+        invalid_data += item["invalid"]
+        total_imgs += ix - first
+        # HDF5 に書き終えてから記録するので、記録された画像は必ず HDF5 にある
+        h5_file.flush()
+        img_ids, img_nums, lat, lng, urban_share = [np.concatenate(c) for c in zip(*provenance)] if provenance else [[]] * 5
+        ledger.finish_file(fm["title"], item["n_images"], img_ids, img_nums, lat, lng, urban_share,
+                           error="DataLossError" if item["invalid"] else None)
+        LOG.info("Wrote: {} images ({:.1f} images/s)".format(
+            total_imgs, total_imgs / (time.time() - start)))
+
+    ledger.export_valid_imgs(outfh_path, tempdir)
     LOG.info("Total images processed: {}".format(ix))
     LOG.info("Invalid data errors: {}".format(invalid_data))
     h5_file.close()
 
 
-def tfr_data_pipeline(path, img_rows, img_cols):
-    # TFRecordのデータ構造を定義してパースするパイプライン
+class ByYearArrays:
+    # IMGData の列ごとに一つの配列に追記する。Table と同じく dtype と append を持つ
+    def __init__(self, h5_file):
+        self.dtype = tables.description.dtype_from_descr(IMGData)
+        self.arrays = {}
+        for f in self.dtype.names:
+            if "/" + f not in h5_file:
+                shape = self.dtype[f].shape
+                h5_file.create_earray("/", f, tables.Atom.from_dtype(self.dtype[f].base), (0,) + shape,
+                                      chunkshape=(CHUNK_IMAGES,) + shape if shape else None, filters=FILTERS)
+            self.arrays[f] = h5_file.get_node("/" + f)
+
+    @property
+    def nrows(self):
+        return self.arrays["img_id"].nrows
+
+    def append(self, rows):
+        for f, array in self.arrays.items():
+            array.append(rows[f])
+
+    def truncate(self, n):
+        for array in self.arrays.values():
+            array.truncate(n)
+
+
+class Pipeline:
+    # ダウンロードとパースのワーカーの共有状態。
+    # 一時フォルダのファイル数は slots で max_files 以下に抑え、パース結果はファイルごとのキューに入れる。
+    # ダウンロードもパースもファイルの順番に取るので、書き込み待ちのファイルが先に進めなくなることはない
+    def __init__(self, src, tempdir, file_list, ledger):
+        self.src = src
+        self.tempdir = tempdir
+        self.file_list = file_list
+        self.ledger = ledger
+        self.paths = [None] * len(file_list)
+        self.downloaded = [threading.Event() for _ in file_list]
+        self.results = [queue.Queue(QUEUE_BATCHES) for _ in file_list]
+        self.slots = threading.Semaphore(max_files)
+        self.download_lock = threading.Lock()
+        self.parse_lock = threading.Lock()
+        self.next_download = 0
+        self.next_parse = 0
+
+    def download_worker(self):
+        while True:
+            with self.download_lock:
+                self.slots.acquire()
+                k = self.next_download
+                self.next_download += 1
+            if k >= len(self.file_list):
+                self.slots.release()
+                return
+            fm = self.file_list[k]
+            LOG.info("DOWNLOADING FILE: {}".format(fm["title"]))
+            self.ledger.set_state(fm["title"], "downloading")
+            start = time.time()
+            try:
+                self.paths[k] = self.src.fetch(fm, self.tempdir)
+                self.ledger.set_state(fm["title"], "downloaded", download_s=time.time() - start)
+            except Exception as e:
+                self.paths[k] = e
+            LOG.info("Download took: {} seconds".format(time.time() - start))
+            self.downloaded[k].set()
+
+    def parse_worker(self):
+        while True:
+            with self.parse_lock:
+                k = self.next_parse
+                self.next_parse += 1
+            if k >= len(self.file_list):
+                return
+            self.downloaded[k].wait()
+            fpath = self.paths[k]
+            if isinstance(fpath, Exception):
+                self.slots.release()
+                self.results[k].put(fpath)
+                continue
+            self.ledger.set_state(self.file_list[k]["title"], "parsing")
+            start = time.time()
+            try:
+                n_images, invalid = self.parse_file(fpath, self.results[k])
+                if self.src.temporary:
+                    os.unlink(fpath)  # 一時ファイル削除
+            except Exception as e:
+                self.slots.release()
+                self.results[k].put(e)
+                continue
+            self.slots.release()
+            self.ledger.set_state(self.file_list[k]["title"], "parsing", parse_s=time.time() - start)
+            self.results[k].put({"path": fpath, "n_images": n_images, "invalid": invalid})
+
+    @staticmethod
+    def parse_file(fpath, results):
+        # 都市化割合が十分な画像をバッチごとに results に入れ、読んだ画像数と壊れたファイルかどうか（1）を返す
+        img_num = 0
+        batch_size = PARSE_BATCH
+        while True:
+            with tf.Graph().as_default():
+                it = tfr_data_pipeline(fpath, IMG_ROWS_RAW, IMG_COLS_RAW, batch_size, img_num)
+                with tf.compat.v1.Session() as sess:
+                    while True:
+                        try:
+                            imgs, lat, lng, urban = sess.run(it)
+                        except tf.errors.OutOfRangeError:
+                            return img_num, 0
+                        except tf.errors.DataLossError:
+                            if batch_size == 1:
+                                return img_num, 1
+                            break
+                        nums = np.arange(img_num + 1, img_num + len(urban) + 1)
+                        img_num += len(urban)
+
+                        urban[np.isnan(urban)] = 0
+                        urban = urban.reshape(len(urban), -1)
+                        keep = urban.mean(1) >= 0.1  # 都市化割合が低い画像はスキップ
+                        if not keep.any():
+                            continue
+
+                        # 軸を (batch, channel, year, row, col) -> (batch, year, col, row, channel) に並べ替え
+                        imgs = imgs[keep].reshape(-1, len(CHANNEL_NAMES), len(YEARS), IMG_ROWS_RAW, IMG_COLS_RAW)
+                        imgs = imgs.transpose(0, 2, 4, 3, 1)
+                        lat = lat[keep, IMG_ROWS_RAW//2, IMG_COLS_RAW//2]
+                        lng = lng[keep, IMG_ROWS_RAW//2, IMG_COLS_RAW//2]
+                        results.put((imgs, lat, lng, np.nanmean(urban[keep], 1), nums[keep]))
+            # 壊れたファイルは最後のバッチの読める画像まで 1 枚ずつ読み直す
+            batch_size = 1
+
+
+def tfr_data_pipeline(path, img_rows, img_cols, batch_size, skip=0):
+    # TFRecordのデータ構造を定義し、batch_size 枚ずつパースするパイプライン
     channel_names = ["{}_{}".format(x,y) for x in CHANNEL_NAMES for y in YEARS]
     other_vars = ["urban", "longitude", "latitude"]
     varnames = channel_names + other_vars
@@ -194,17 +360,13 @@ def tfr_data_pipeline(path, img_rows, img_cols):
     features = [tf.compat.v1.FixedLenFeature([img_rows*img_cols], tf.float32)] * len(varnames)
     features_dict = dict(zip(varnames, features))
 
-    def parse_example(example_proto):
-        parsed_features = tf.compat.v1.parse_single_example(example_proto, features_dict)
-        f = lambda x: tf.reshape(x, (img_rows, img_cols))
-        imgs = {}
-        axes = [2, 1, 0]  # 軸を (channel, row, col) -> (row, col, channel) に並べ替え
+    def parse_batch(example_protos):
+        parsed_features = tf.compat.v1.io.parse_example(example_protos, features_dict)
+        f = lambda x: tf.reshape(x, (-1, img_rows, img_cols))
 
-        for y in YEARS:
-            cname = ["{}_{}".format(x,y) for x in CHANNEL_NAMES]
-            ii = tf.stack([f(parsed_features[x]) for x in cname], 0)
-            ii = tf.transpose(ii, axes)
-            imgs[y] = ii
+        # 画像は (batch, channel * year, row * col) のまま返し、軸の並べ替えは都市化割合で
+        # 絞った後に numpy で行う
+        imgs = tf.stack([parsed_features[x] for x in channel_names], 1)
 
         urban = f(parsed_features["urban"])
         lat = f(parsed_features["latitude"])
@@ -212,8 +374,8 @@ def tfr_data_pipeline(path, img_rows, img_cols):
 
         return imgs, lat, lng, urban
 
-    ds = tf.data.TFRecordDataset(path)
-    parsed_ds = ds.map(parse_example)
+    ds = tf.data.TFRecordDataset(path).skip(skip).batch(batch_size)
+    parsed_ds = ds.map(parse_batch)
     it = tf.compat.v1.data.make_one_shot_iterator(parsed_ds)
     return it.get_next()
 
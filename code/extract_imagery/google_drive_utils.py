@@ -3,12 +3,15 @@ import time
 import random
 import logging
 import pydrive
+import threading
 import numpy as np
 import multiprocessing as mp
 
 from pydrive import auth
 from pydrive import drive
 
+from sources import RANGED_MIN_SIZE, verify_file, download_ranges
+
 
 LOG = logging.getLogger(os.path.basename(__file__))
 ch = logging.StreamHandler()
@@ -21,7 +24,7 @@ LOG.setLevel(logging.INFO)
 
 class GDFolderDownloader:
     
-    def __init__(self, root_dir_id, out_dir, config_path, processed_paths_file):
+    def __init__(self, root_dir_id, out_dir, config_path, transport=None, workers=4):
         self.gauth = auth.GoogleAuth()
         self.gauth.LoadClientConfigFile(config_path)
         self.gauth.LoadCredentialsFile("credentials.txt")
@@ -37,7 +40,8 @@ class GDFolderDownloader:
         LOG.info("QUERY: " + query)
         self.file_list = self.gdrive.ListFile({"q": query}).GetList()
         self.out_dir = out_dir
-        self.processed_paths = processed_paths_file
+        self.transport = transport if transport is not None else DriveTransport(self.gauth)
+        self.workers = workers
 
         if not os.path.exists(out_dir):
             os.makedirs(out_dir)
@@ -56,53 +60,17 @@ class GDFolderDownloader:
             LOG.warning(
                 "Path: {} exists. Delete it to download again".format(outpath))
             return outpath
-        with open(self.processed_paths) as fh:
-            to_skip = fh.read().split("\n")
-        if outpath in to_skip:
-            LOG.warning(
-                "Path: {} exists. Delete it to download again".format(outpath))
-            return None
-
         total_size = int(file_meta["fileSize"])
-        if total_size <= 1e9:
-            gh.GetContentFile(outpath)
+        md5 = file_meta.get("md5Checksum")
+        if total_size <= RANGED_MIN_SIZE:
+            gh.GetContentFile(outpath + ".part")
+            verify_file(outpath + ".part", total_size, md5)
+            os.replace(outpath + ".part", outpath)
         else:
-            url = file_meta["downloadUrl"]
-            chunksize = int(5e8)
-            chunks = self.partial(total_size, chunksize)
-            chunks[-1][1] += 1
-            service = self.gauth.service
-            try:
-                with open(outpath, "wb") as fh:
-                    for byte_begin, byte_end in chunks:
-                        content = self.download_chunk(
-                            url, service, byte_begin, byte_end)
-                        fh.write(content)
-            except:
-                os.unlink(outpath)
-                raise
+            download_ranges(file_meta["downloadUrl"], outpath, total_size, self.transport, md5, workers=self.workers)
 
         return outpath
 
-    @staticmethod
-    def partial(total_byte_len, part_size_limit):
-        s = []
-        for p in range(0, total_byte_len, part_size_limit):
-            last = min(total_byte_len - 1, p + part_size_limit - 1)
-            s.append([p, last])
-        return s
-
-    @staticmethod
-    def download_chunk(url, service, byte_begin, byte_end):
-        headers = {"Range": "bytes={}-{}".format(byte_begin, byte_end)}
-        start = time.time()
-        resp, content = service._http.request(url, headers=headers)
-        if resp.status != 206:
-            msg = "Error downloading chunk: {}".format(resp)
-            raise StandardError(msg)
-        return content        
-
-
     def file_iterator(self, num_files=-1):
         num_files = num_files if num_files > 0 else len(self.file_list)
         for fm in self.file_list:
@@ -114,4 +82,24 @@ class GDFolderDownloader:
                 outpath = None
 
             print("Download took: {} seconds".format(time.time() - start))
-            yield outpath
\ No newline at end of file
+            yield outpath
+
+
+class DriveTransport:
+    """Ranged GET requests through the authorised Drive client.
+
+    httplib2 clients are not thread safe, so every download thread gets its own.
+    """
+
+    def __init__(self, gauth):
+        self.gauth = gauth
+        self.local = threading.local()
+
+    def __call__(self, url, byte_begin, byte_end):
+        if not hasattr(self.local, "http"):
+            self.local.http = self.gauth.Get_Http_Object()
+        headers = {"Range": "bytes={}-{}".format(byte_begin, byte_end)}
+        resp, content = self.local.http.request(url, headers=headers)
+        if resp.status != 206:
+            raise IOError("Error downloading chunk: {}".format(resp))
+        return content
@@ -0,0 +1,121 @@
+import os
+import time
+import sqlite3
+import threading
+import numpy as np
+
+# states of a file: listed -> downloading -> downloaded -> parsing -> parsed, or failed with the error
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    title TEXT PRIMARY KEY,
+    size INTEGER,
+    state TEXT NOT NULL,
+    error TEXT,
+    n_images INTEGER,
+    n_valid INTEGER,
+    download_s REAL,
+    parse_s REAL,
+    updated_at REAL
+);
+CREATE TABLE IF NOT EXISTS images (
+    img_id INTEGER PRIMARY KEY,
+    title TEXT NOT NULL,
+    img_num INTEGER NOT NULL,
+    lat REAL,
+    lng REAL,
+    urban_share REAL
+);
+"""
+
+
+class IngestLedger:
+    """SQLite record of the ingest: the state and timings of every source file and the provenance of every image.
+
+    A file's images are added in the same transaction that marks it parsed, so after a crash the
+    ledger holds exactly the images of the parsed files. The connection is shared by the download,
+    parse and writer threads under a lock; WAL mode lets other processes read it meanwhile.
+    """
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+        self.lock = threading.Lock()
+
+    def list_files(self, file_list):
+        # adds files not seen before; files a crashed run left half done are listed again
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO files (title, size, state, updated_at) VALUES (?, ?, 'listed', ?)",
+                [(fm["title"], int(fm["fileSize"]), time.time()) for fm in file_list])
+            self.conn.execute(
+                "UPDATE files SET state = 'listed' WHERE state IN ('downloading', 'downloaded', 'parsing')")
+
+    def state(self, title):
+        with self.lock:
+            row = self.conn.execute("SELECT state FROM files WHERE title = ?", (title,)).fetchone()
+        return None if row is None else row[0]
+
+    def set_state(self, title, state, error=None, **timings):
+        # timings are download_s and parse_s
+        columns = "".join(", {} = ?".format(k) for k in timings)
+        with self.lock, self.conn:
+            self.conn.execute(
+                "UPDATE files SET state = ?, error = ?, updated_at = ?{} WHERE title = ?".format(columns),
+                (state, error, time.time()) + tuple(timings.values()) + (title,))
+
+    def finish_file(self, title, n_images, img_ids, img_nums, lat, lng, urban_share, error=None):
+        """Records the images written from a file and marks it parsed, in one transaction."""
+        rows = zip(np.asarray(img_ids).tolist(), [title] * len(img_ids), np.asarray(img_nums).tolist(),
+                   np.asarray(lat).tolist(), np.asarray(lng).tolist(), np.asarray(urban_share).tolist())
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT INTO images (img_id, title, img_num, lat, lng, urban_share) VALUES (?, ?, ?, ?, ?, ?)", rows)
+            self.conn.execute(
+                "UPDATE files SET state = 'parsed', error = ?, n_images = ?, n_valid = ?, updated_at = ? WHERE title = ?",
+                (error, n_images, len(img_ids), time.time(), title))
+
+    def n_images(self):
+        """Number of images of the parsed files, which is also the last img_id given out."""
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM images").fetchone()[0]
+
+    def pending(self, file_list):
+        """The files of file_list that are not parsed yet, in order."""
+        with self.lock:
+            parsed = {row[0] for row in self.conn.execute("SELECT title FROM files WHERE state = 'parsed'")}
+        return [fm for fm in file_list if fm["title"] not in parsed]
+
+    def export_valid_imgs(self, path, tempdir):
+        """Writes the valid_imgs text file the labelling scripts read, one line per image in img_id order."""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT title, img_num, img_id, lat, lng, urban_share FROM images ORDER BY img_id").fetchall()
+        with open(path + ".tmp", "w") as fh:
+            for title, img_num, img_id, lat, lng, urban_share in rows:
+                # the values were float32 when first written
+                fh.write("{},{},{},{},{},{}\n".format(
+                    "{}/{}".format(tempdir, title), img_num, img_id,
+                    np.float32(lat), np.float32(lng), np.float32(urban_share)))
+        os.replace(path + ".tmp", path)
+
+    def import_text_files(self, processed_paths_file, valid_imgs_file):
+        """Fills an empty ledger from the processed_paths and valid_imgs text files of earlier ingests."""
+        if self.n_images() > 0 or not os.path.exists(processed_paths_file):
+            return
+        with open(processed_paths_file) as fh:
+            titles = [os.path.basename(line) for line in fh.read().split("\n") if line]
+        images = []
+        if os.path.exists(valid_imgs_file):
+            with open(valid_imgs_file) as fh:
+                for line in fh:
+                    fpath, img_num, img_id, lat, lng, urban_share = line.rstrip("\n").rsplit(",", 5)
+                    images.append((int(img_id), os.path.basename(fpath), int(img_num),
+                                   float(lat), float(lng), float(urban_share)))
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO files (title, state, updated_at) VALUES (?, 'parsed', ?)",
+                [(title, time.time()) for title in titles])
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO images (img_id, title, img_num, lat, lng, urban_share) VALUES (?, ?, ?, ?, ?, ?)",
+                images)
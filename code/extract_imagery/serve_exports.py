@@ -0,0 +1,54 @@
+import os
+import sys
+import json
+import time
+import urllib.parse
+import http.server
+
+# Serves a directory of exported .tfrecord files to download_data.py (source http://host:port):
+# GET / lists the files as JSON, GET /<file> with a Range header returns those bytes.
+# latency_ms delays every response, to stand in for a remote store when benchmarking.
+# Usage: python serve_exports.py directory [port] [latency_ms]
+
+
+class ExportHandler(http.server.BaseHTTPRequestHandler):
+    directory = "."
+    latency_ms = 0
+
+    def do_GET(self):
+        time.sleep(self.latency_ms / 1000)
+        name = urllib.parse.unquote(self.path.lstrip("/"))
+        if name == "":
+            files = sorted(os.listdir(self.directory))
+            content = json.dumps([{"title": f, "fileSize": os.path.getsize(os.path.join(self.directory, f))}
+                                  for f in files]).encode()
+            self.send_response(200)
+        else:
+            path = os.path.join(self.directory, os.path.basename(name))
+            if not os.path.isfile(path) or "Range" not in self.headers:
+                self.send_error(404 if not os.path.isfile(path) else 416)
+                return
+            begin, end = [int(x) for x in self.headers["Range"].split("=")[1].split("-")]
+            with open(path, "rb") as fh:
+                fh.seek(begin)
+                content = fh.read(end - begin + 1)
+            self.send_response(206)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+def main():
+    ExportHandler.directory = sys.argv[1]
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 8000
+    ExportHandler.latency_ms = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+    server = http.server.ThreadingHTTPServer(("", port), ExportHandler)
+    print("Serving {} at http://localhost:{}/".format(ExportHandler.directory, server.server_port))
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
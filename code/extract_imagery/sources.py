@@ -0,0 +1,202 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+
+LOG = logging.getLogger(os.path.basename(__file__))
+ch = logging.StreamHandler()
+log_fmt = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+ch.setFormatter(logging.Formatter(log_fmt))
+ch.setLevel(logging.INFO)
+LOG.addHandler(ch)
+LOG.setLevel(logging.INFO)
+
+# files larger than this are downloaded in ranges of CHUNK_SIZE bytes, several at a time
+RANGED_MIN_SIZE = 1e9
+CHUNK_SIZE = int(1e8)
+RETRIES = 3
+
+# Sources of the exported .tfrecord files. Each one has
+#   list()                          file metadata dicts holding at least "title" and "fileSize"
+#   read(file_meta, begin, end)     bytes begin to end (inclusive) of a file
+#   fetch(file_meta, out_dir)       local path of the whole file, downloaded into out_dir if need be
+#   temporary                       whether fetched files are copies to delete once parsed
+
+
+def open_source(spec, root_dir_id, out_dir, config_path):
+    """Source named by spec: "drive", an http(s):// URL of serve_exports.py, or a local directory."""
+    if spec == "drive":
+        return DriveSource(root_dir_id, out_dir, config_path)
+    if spec.startswith("http://") or spec.startswith("https://"):
+        return HTTPSource(spec)
+    if os.path.isdir(spec):
+        return LocalSource(spec)
+    raise Exception("Source must be 'drive', an http(s) URL or a directory: {}".format(spec))
+
+
+class DriveSource:
+    """The Google Drive folder root_dir_id, through PyDrive."""
+    temporary = True
+
+    def __init__(self, root_dir_id, out_dir, config_path):
+        # PyDrive and its credentials are only needed for this source
+        from google_drive_utils import GDFolderDownloader
+        self.GD = GDFolderDownloader(root_dir_id, out_dir, config_path)
+
+    def list(self):
+        return self.GD.file_list
+
+    def read(self, file_meta, byte_begin, byte_end):
+        return self.GD.transport(file_meta["downloadUrl"], byte_begin, byte_end)
+
+    def fetch(self, file_meta, out_dir):
+        return self.GD.download_one_file(file_meta, out_dir, self.GD.gdrive)
+
+
+class LocalSource:
+    """A local or NFS directory of exported files, which are parsed where they are."""
+    temporary = False
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def list(self):
+        return [{"title": f, "fileSize": os.path.getsize(os.path.join(self.directory, f))}
+                for f in sorted(os.listdir(self.directory))]
+
+    def read(self, file_meta, byte_begin, byte_end):
+        with open(os.path.join(self.directory, file_meta["title"]), "rb") as fh:
+            fh.seek(byte_begin)
+            return fh.read(byte_end - byte_begin + 1)
+
+    def fetch(self, file_meta, out_dir):
+        path = os.path.join(self.directory, file_meta["title"])
+        verify_file(path, int(file_meta["fileSize"]), delete=False)
+        return path
+
+
+class HTTPSource:
+    """Exported files served over HTTP by serve_exports.py, which lists them as JSON at base_url."""
+    temporary = True
+
+    def __init__(self, base_url, workers=4):
+        self.base_url = base_url.rstrip("/") + "/"
+        self.transport = HTTPTransport()
+        self.workers = workers
+
+    def url(self, file_meta):
+        return self.base_url + urllib.parse.quote(file_meta["title"])
+
+    def list(self):
+        with urllib.request.urlopen(self.base_url) as resp:
+            return json.load(resp)
+
+    def read(self, file_meta, byte_begin, byte_end):
+        return self.transport(self.url(file_meta), byte_begin, byte_end)
+
+    def fetch(self, file_meta, out_dir):
+        outpath = "{}/{}".format(out_dir, file_meta["title"])
+        if os.path.exists(outpath):
+            LOG.warning("Path: {} exists. Delete it to download again".format(outpath))
+            return outpath
+        download_ranges(self.url(file_meta), outpath, int(file_meta["fileSize"]), self.transport,
+                        file_meta.get("md5Checksum"), workers=self.workers)
+        return outpath
+
+
+class HTTPTransport:
+    """Ranged GET requests over plain HTTP, e.g. from a local mirror of the exports."""
+
+    def __call__(self, url, byte_begin, byte_end):
+        request = urllib.request.Request(url, headers={"Range": "bytes={}-{}".format(byte_begin, byte_end)})
+        with urllib.request.urlopen(request) as resp:
+            if resp.status != 206:
+                raise IOError("Error downloading chunk: {} {}".format(resp.status, url))
+            return resp.read()
+
+
+def partial(total_byte_len, part_size_limit):
+    s = []
+    for p in range(0, total_byte_len, part_size_limit):
+        last = min(total_byte_len - 1, p + part_size_limit - 1)
+        s.append([p, last])
+    return s
+
+
+def verify_file(path, total_size, md5=None, delete=True):
+    """Raises IOError, after deleting path unless delete is False, if its size or MD5 checksum is not the expected one."""
+    error = None
+    if os.path.getsize(path) != total_size:
+        error = "{} has {} bytes instead of {}".format(path, os.path.getsize(path), total_size)
+    elif md5 is not None:
+        digest = hashlib.md5()
+        with open(path, "rb") as fh:
+            for block in iter(lambda: fh.read(2 ** 23), b""):
+                digest.update(block)
+        if digest.hexdigest() != md5:
+            error = "{} has MD5 {} instead of {}".format(path, digest.hexdigest(), md5)
+    if error is not None:
+        if delete:
+            os.unlink(path)
+        raise IOError(error)
+
+
+def download_ranges(url, outpath, total_size, transport, md5=None, chunk_size=CHUNK_SIZE, workers=4):
+    """Downloads url to outpath in ranges of chunk_size bytes, workers ranges at a time.
+
+    transport(url, byte_begin, byte_end) returns the bytes of a range. Ranges are written into
+    outpath.part and recorded in outpath.part.json once on disk, so a download that failed
+    resumes with the missing ranges only. The file is renamed to outpath after verify_file.
+    """
+    part_path = outpath + ".part"
+    state_path = part_path + ".json"
+    chunks = partial(total_size, chunk_size)
+    state = {"total_size": total_size, "chunk_size": chunk_size, "done": []}
+    if os.path.exists(part_path) and os.path.exists(state_path):
+        with open(state_path) as fh:
+            saved = json.load(fh)
+        if saved["total_size"] == total_size and saved["chunk_size"] == chunk_size:
+            state = saved
+            LOG.info("Resuming {} with {} of {} chunks done".format(outpath, len(state["done"]), len(chunks)))
+    if len(state["done"]) == 0:
+        with open(part_path, "wb") as fh:
+            fh.truncate(total_size)
+
+    lock = threading.Lock()
+    fd = os.open(part_path, os.O_WRONLY)
+
+    def fetch(i):
+        byte_begin, byte_end = chunks[i]
+        for attempt in range(RETRIES):
+            try:
+                content = transport(url, byte_begin, byte_end)
+                if len(content) != byte_end - byte_begin + 1:
+                    raise IOError("Got {} bytes of chunk {}-{}".format(len(content), byte_begin, byte_end))
+                break
+            except Exception as e:
+                if attempt == RETRIES - 1:
+                    raise
+                LOG.warning("Retrying chunk {}-{} of {}: {}".format(byte_begin, byte_end, outpath, e))
+        os.pwrite(fd, content, byte_begin)
+        os.fsync(fd)
+        with lock:
+            state["done"].append(i)
+            with open(state_path + ".tmp", "w") as fh:
+                json.dump(state, fh)
+            os.replace(state_path + ".tmp", state_path)
+
+    try:
+        with ThreadPoolExecutor(workers) as pool:
+            list(pool.map(fetch, [i for i in range(len(chunks)) if i not in state["done"]]))
+    finally:
+        os.close(fd)
+    # an empty file, or one whose chunks were all done by an earlier run, has no state written by this one
+    if os.path.exists(state_path):
+        os.unlink(state_path)
+    verify_file(part_path, total_size, md5)
+    os.replace(part_path, outpath)
@@ -0,0 +1,166 @@
+import os
+os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
+import sys
+import time
+import numpy as np
+import pandas as pd
+import tables
+from prep_utils import LabelIndex, categorical_codes, by_year_path, read_blocks, crop_scale, write_by_year, \
+    read_years, count_rows
+
+# Usage:
+# python benchmark_prep.py join [n_labels] [n_rows]  label join on a synthetic label table
+# python benchmark_prep.py read raw_h5_path [block_size] [labelled_fraction]  image reads from a raw HDF5 file
+#   and, if split_years.py has been run on it, from its per-year copy
+# python benchmark_prep.py layout raw_h5_path [chunk_images] [complevel] [block_size]  file size and single-year
+#   reads of a raw HDF5 file and of temporary per-year copies, uncompressed and Blosc/LZ4 compressed
+mode = sys.argv[1]
+N_FEATURES = 40
+N_COUNTIES = 3000
+N_STATES = 50
+
+
+def make_labels(n):
+    rng = np.random.default_rng(0)
+    label = pd.DataFrame({'img_id': rng.permutation(n) + 1,
+                          'subset': rng.choice(['train', 'validation', 'test'], n)})
+    for c in ['urban', 'popshare_00', 'log_inc_00', 'log_inc_10', 'log_inc_15', 'log_pop_00', 'log_pop_10']:
+        label[c] = rng.normal(size=n).astype(np.float32)
+    columns = ['log_pop_cnty_00', 'log_inc_cnty_00', 'white_00'] + ['f{}'.format(i) for i in range(N_FEATURES - 3)]
+    scaled_features = pd.DataFrame(rng.random((n, N_FEATURES)), columns=columns)
+    label['county'] = rng.integers(0, N_COUNTIES, n)
+    label['state'] = rng.integers(0, N_STATES, n)
+    return label, scaled_features
+
+
+def join_scan(label, scaled_features, categorical_values, img_ids):
+    # the per-row join the prep scripts used before LabelIndex
+    for img_id in img_ids:
+        check_id = (label['img_id'] == img_id)
+        if check_id.any():
+            label[check_id]['subset'].item()
+            label[check_id]['urban'].item()
+            label[check_id]['popshare_00'].item()
+            label[check_id]['log_inc_00'].item()
+            label[check_id]['log_pop_00'].item()
+            features = scaled_features[check_id.to_numpy()]
+            np.concatenate((features.loc[:, ['log_pop_cnty_00', 'log_inc_cnty_00']],
+                            features.loc[:, 'white_00':]), axis=-1).astype(np.float32)
+            np.array(categorical_values[check_id.to_numpy()], dtype=np.float32)
+
+
+def join_index(label_index, img_ids):
+    for img_id in img_ids:
+        label_index.lookup(img_id)
+
+
+def report(name, n, seconds):
+    print("{:<24} {:>10} rows {:>10.2f} s {:>14.1f} rows/s".format(name, n, seconds, n / seconds))
+
+
+def bench_join(n_labels, n_rows):
+    print("Label table: {} images, joining {} HDF5 rows".format(n_labels, n_rows))
+    label, scaled_features = make_labels(n_labels)
+    img_ids = np.random.default_rng(1).integers(1, n_labels + 1, n_rows)
+
+    start = time.time()
+    categorical_values = pd.get_dummies(label.loc[:, 'county':'state'], columns=['county', 'state'])
+    join_scan(label, scaled_features, categorical_values, img_ids)
+    report('boolean scan', n_rows, time.time() - start)
+
+    start = time.time()
+    label_index = LabelIndex(label, scaled_features, *categorical_codes(label))
+    report('LabelIndex build', n_labels, time.time() - start)
+    start = time.time()
+    join_index(label_index, img_ids)
+    report('LabelIndex lookup', n_rows, time.time() - start)
+
+
+def bytes_read():
+    # bytes returned by read syscalls so far, page cache hits included
+    with open('/proc/self/io') as fh:
+        for line in fh:
+            if line.startswith('rchar'):
+                return int(line.split()[1])
+
+
+def report_bytes(name, n, nbytes):
+    print("{:<24} {:>10} rows {:>14.0f} bytes read per sample".format(name, n, nbytes / n))
+
+
+def bench_read(raw_path, block_size, fraction):
+    dataset = tables.open_file(raw_path)
+    node = dataset.root.data
+    rng = np.random.default_rng(0)
+    coords = np.sort(rng.choice(node.nrows, int(node.nrows * fraction), replace=False))
+    img_ids = node.col('img_id')[coords]
+    labelled = np.zeros(node.nrows, dtype=bool)
+    labelled[coords] = True
+    scaler = np.ones((1, node.coldescrs['img0'].shape[-1]), dtype=np.float32)
+    paths = [raw_path] + ([by_year_path(raw_path)] if os.path.exists(by_year_path(raw_path)) else [])
+
+    for mode, years in [('levels/diffs', [0, 10]), ('testing', [0, 10, 15])]:
+        print("Reading years {} ({}) of {} labelled rows out of {}".format(years, mode, len(coords), node.nrows))
+        start, nbytes = time.time(), bytes_read()
+        for nr, row in enumerate(node.iterrows()):
+            if labelled[nr]:
+                for year in years:
+                    img = row['img{}'.format(year)].astype(np.float32)
+                    img = img / scaler
+                    img = img[7:-7, 7:-7, :]
+        report('iterrows', len(coords), time.time() - start)
+        report_bytes('iterrows', len(coords), bytes_read() - nbytes)
+        for path in paths:
+            name = 'read_blocks {} ({})'.format('by_year' if path != raw_path else 'raw', block_size)
+            with tables.open_file(path) as images:
+                start, nbytes = time.time(), bytes_read()
+                for block in read_blocks(images, img_ids, years, block_size):
+                    for year in years:
+                        crop_scale(block['img{}'.format(year)], scaler, 7)
+                report(name, len(coords), time.time() - start)
+                report_bytes(name, len(coords), bytes_read() - nbytes)
+    dataset.close()
+
+
+def bench_layout(raw_path, chunk_images, complevel, block_size):
+    raw = tables.open_file(raw_path)
+    paths = {'raw': raw_path}
+    for name, chunks, level in [('by_year', 1, 0), ('by_year lz4 ({})'.format(chunk_images), chunk_images, complevel)]:
+        path = raw_path[:-len('.h5')] + '_bench{}.h5'.format(len(paths))
+        start = time.time()
+        write_by_year(raw, path, block_size, chunks, level)
+        print("Wrote {} copy in {:.1f} s".format(name, time.time() - start))
+        paths[name] = path
+    scaler = np.ones((1, raw.root.data.coldescrs['img15'].shape[-1]), dtype=np.float32)
+    raw.close()
+
+    print("Reading year 15 of every row, {} rows at a time".format(block_size))
+    for name, path in paths.items():
+        with tables.open_file(path) as images:
+            n = count_rows(images)
+            start, nbytes = time.time(), bytes_read()
+            for first in range(0, n, block_size):
+                crop_scale(read_years(images, [15], first, min(first + block_size, n))['img15'], scaler, 7)
+            seconds, nbytes = time.time() - start, bytes_read() - nbytes
+        print("{:<24} {:>10.1f} MB".format(name, os.path.getsize(path) / 2 ** 20))
+        report(name, n, seconds)
+        report_bytes(name, n, nbytes)
+    for name, path in paths.items():
+        if path != raw_path:
+            os.remove(path)
+
+
+def main():
+    if mode == 'join':
+        bench_join(int(sys.argv[2]) if len(sys.argv) > 2 else 770000, int(sys.argv[3]) if len(sys.argv) > 3 else 2000)
+    elif mode == 'read':
+        bench_read(sys.argv[2], int(sys.argv[3]) if len(sys.argv) > 3 else 64, float(sys.argv[4]) if len(sys.argv) > 4 else 1.0)
+    elif mode == 'layout':
+        bench_layout(sys.argv[2], int(sys.argv[3]) if len(sys.argv) > 3 else 16, int(sys.argv[4]) if len(sys.argv) > 4 else 5,
+                     int(sys.argv[5]) if len(sys.argv) > 5 else 64)
+    else:
+        sys.exit('pls use "join", "read" or "layout" for mode')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,398 @@
+import os
+os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
+import tensorflow as tf
+physical_devices = tf.config.experimental.list_physical_devices('GPU')
+if len(physical_devices) > 0:
+    tf.config.experimental.set_memory_growth(physical_devices[0], True)
+import glob
+import multiprocessing as mp
+import numpy as np
+import sys
+from prep_utils import IMAGE_FORMATS, load_label_index, label_path, image_store_path, open_images, count_rows, image_shape, \
+    read_blocks, load_manifest, save_manifest, crop_scale, quantize_image, encode_image, open_image_store, index_path, save_index
+
+ROOT = os.environ.get("CNN_PROJECT_ROOT", "../")
+
+# Image years of the TFRecord layouts: all holds one record per image and year for the levels models,
+# diff pairs 2000 with 2010 for the diff models and 15 holds 2000, 2010 and 2015 for the predictions.
+LAYOUT_YEARS = {'all': [0, 10], 'diff': [0, 10], '15': [0, 10, 15]}
+# With workers, the HDF5 rows are dealt to the worker processes in chunks of this many blocks,
+# and each worker fills this many shards of every set at once, picking one at random per example.
+CHUNK_BLOCKS = 16
+OPEN_SHARDS = 8
+
+# popshare = 0.85
+# urb = 0.1
+size = sys.argv[1] # small or large
+construct = sys.argv[2] # BG or block
+region = sys.argv[3] # national or mw
+layouts = sys.argv[4].split(',') if len(sys.argv) > 4 else ['all', 'diff', '15'] # comma separated, e.g. all,diff
+block_size = int(sys.argv[5]) if len(sys.argv) > 5 else 64 # HDF5 rows read per block, trades throughput for memory
+image_format = sys.argv[6] if len(sys.argv) > 6 else 'float32' # float32, uint16 or uint8
+compression = sys.argv[7] if len(sys.argv) > 7 else '' # '', GZIP or ZLIB
+# full; images to leave the labels to the label sidecar; ids to also leave the pixels to the image store
+records = sys.argv[8] if len(sys.argv) > 8 else 'full'
+part_rows = int(sys.argv[9]) if len(sys.argv) > 9 else 0 # HDF5 rows per resumable output part, 0 for one file per set
+# processes writing the final shards in place of shard_data.py, 0 for one file per set (or part)
+workers = int(sys.argv[10]) if len(sys.argv) > 10 else 0
+n_images_shard = int(sys.argv[11]) if len(sys.argv) > 11 else 0 # examples per shard, with workers
+if any(layout not in LAYOUT_YEARS for layout in layouts):
+    sys.exit('invalid layout')
+if image_format not in IMAGE_FORMATS:
+    sys.exit('invalid image_format')
+if records not in ['full', 'images', 'ids']:
+    sys.exit('invalid records')
+if workers > 0 and part_rows > 0:
+    sys.exit('part_rows and workers cannot be combined')
+if workers > 0 and n_images_shard <= 0:
+    sys.exit('pls give the number of examples per shard with workers')
+
+if size == "large":
+    if region == "mw":
+        sys.exit('mw data only has small images')
+    elif region == "national":
+        TOP_CODES = [2500, 2500, 2500, 10000, 10000, 10000, 10000, 63]
+    else:
+        sys.exit('invalid region')
+elif size == "small":
+    if region == "mw":
+        TOP_CODES = [2500, 2500, 2500, 0.5, 0.5, 0.5]
+    elif region == "national":
+        TOP_CODES = [2500, 2500, 2500, 10000, 10000, 10000, 10000]
+    else:
+        sys.exit('invalid region')
+
+YEARS = sorted(set(year for layout in layouts for year in LAYOUT_YEARS[layout]))
+CROP = 7 if region == "national" else 14
+
+
+def main():
+    scaler = np.array(TOP_CODES).astype(np.float32).reshape(1,-1)
+    if region == "mw":
+        raw_path = f"{ROOT}/temp/high_resolution_small_images_raw.h5"
+    elif region == "national":
+        raw_path = f"{ROOT}/temp/{size}_images_all_years_raw.h5"
+    dataset = open_images(raw_path)
+    label_index = load_label_index(ROOT, construct, size, region)
+    if records != 'full':
+        label_index.save(label_path(ROOT, construct, size, region))
+    store = None
+    if records == 'ids':
+        store = open_image_store(image_store_path(ROOT, construct, size, region), label_index.img_ids, YEARS,
+                                 image_shape(dataset, YEARS[0], CROP), image_format)
+    print("Prep {} datasets for {} {} {} images".format(", ".join(layouts), construct, region, size))
+    if workers > 0:
+        n_rows = count_rows(dataset)
+        # the workers open the image file themselves; an HDF5 handle must not be shared across a fork
+        dataset.close()
+        write_shards(raw_path, n_rows, label_index, ['train', 'validation', 'test'], scaler, store)
+    else:
+        write_example(dataset, label_index, ['train', 'validation', 'test'], scaler, store)
+    print("Complete!")
+
+def write_example(dataset, label_index, subsets, scaler, store):
+    print("Start creating {} sets...".format(", ".join(subsets)))
+    if part_rows == 0:
+        ne = write_part(dataset, label_index, subsets, scaler, store, '', 0, None)
+    else:
+        # each part covers a fixed range of HDF5 rows and is listed in the manifest once all its files are
+        # complete, so a restarted run skips the finished ranges and carries on with the next part
+        manifest_path = f'{ROOT}/temp/{construct}_{size}_{region}_prep_manifest.json'
+        n_rows = count_rows(dataset)
+        config = {'layouts': layouts, 'image_format': image_format, 'compression': compression, 'records': records,
+                  'part_rows': part_rows, 'n_rows': n_rows, 'n_labels': len(label_index)}
+        manifest = load_manifest(manifest_path, config)
+        for first in range(0, n_rows, part_rows):
+            part = 'part{:05d}'.format(first // part_rows)
+            last = min(first + part_rows, n_rows)
+            if part in manifest['parts']:
+                print("Skipping rows {} to {}, finished in a previous run".format(first, last))
+                continue
+            ne = write_part(dataset, label_index, subsets, scaler, store, part, first, last)
+            manifest['parts'][part] = {'rows': [first, last], 'examples': {'{}/{}'.format(*key): n for key, n in ne.items()}}
+            save_manifest(manifest_path, manifest)
+        ne = {(layout, subset): sum(p['examples']['{}/{}'.format(layout, subset)] for p in manifest['parts'].values())
+              for layout in layouts for subset in subsets}
+    for layout in layouts:
+        for subset in subsets:
+            print("Finish! Adding {} samples in {} {} set".format(ne[(layout, subset)], layout, subset))
+
+
+def write_part(dataset, label_index, subsets, scaler, store, part, first, last):
+    paths = {(layout, subset): f'{ROOT}/temp/{subset}_{construct}_{size}_{layout}_{region}' + (f'-{part}' if part else '') + '.tfrecords'
+             for layout in layouts for subset in subsets}
+    # parts are written under a temporary name, so that no complete-looking part is left by a crash
+    writers = {key: tf.io.TFRecordWriter(path + ('.tmp' if part else ''), options=compression) for key, path in paths.items()}
+    try:
+        ne = dict.fromkeys(writers, 0)
+        for key, img_id, example in get_examples(dataset, label_index, subsets, scaler, store, first, last):
+            writers[key].write(example)
+            ne[key] += 1
+    finally:
+        for writer in writers.values():
+            writer.close()
+    if store is not None:
+        for array in store.values():
+            array.flush()
+    if part:
+        for path in paths.values():
+            os.replace(path + '.tmp', path)
+    return ne
+
+
+def shard_path(layout, subset):
+    """Shard file names of a set, as shard_data.py writes them and data_loader.read_files globs them."""
+    return f'{ROOT}/temp/{size}_{construct}_{layout}_{region}/{subset}_{construct}_{size}_{layout}_{region}_{{}}.tfrecords'
+
+
+def write_shards(raw_path, n_rows, label_index, subsets, scaler, store):
+    """Writes the shards of every layout and subset from a pool of worker processes.
+
+    The HDF5 rows are dealt to the workers in chunks, round robin, so that the shards of each worker
+    mix images from the whole file. Each worker names its shards after itself; once all are done, the
+    part-filled shards the workers closed at the end are merged by merge_tails, so that a set has as
+    many shards of n_images_shard examples as shard_data.py would write, and the shards are renamed to
+    the NNNNN-of-NNNNN names of shard_data.py and given their record indexes.
+    """
+    print("Start creating {} sets with {} workers...".format(", ".join(subsets), workers))
+    for layout in layouts:
+        os.makedirs(os.path.dirname(shard_path(layout, '')), exist_ok=True)
+        for subset in subsets:
+            # shards of an earlier run with another shard count would be globbed along with the new ones
+            # and the manifest of a shard_data.py run would give loaders the record counts of its shards
+            stale = shard_path(layout, subset).format('*')
+            for path in glob.glob(stale) + glob.glob(stale + '.tmp') + glob.glob(index_path(stale)) + \
+                    glob.glob(shard_path(layout, subset).format('manifest')[:-len('.tfrecords')] + '.json'):
+                os.remove(path)
+    # forked, so the workers share the label index and image store instead of pickling them
+    with mp.get_context('fork').Pool(workers, init_worker, (raw_path, n_rows, label_index, subsets, scaler, store)) as pool:
+        shards = pool.map(write_worker, range(workers))
+    rng = np.random.default_rng()
+    for layout in layouts:
+        for subset in subsets:
+            written = [shard for worker in shards for shard in worker[(layout, subset)]]
+            tails = [shard for shard in written if len(shard[1]) < n_images_shard]
+            written = [shard for shard in written if len(shard[1]) == n_images_shard] + \
+                merge_tails(tails, shard_path(layout, subset), rng)
+            for i, (path, img_ids, lengths) in enumerate(written):
+                path_final = shard_path(layout, subset).format('%.5d-of-%.5d' % (i, len(written) - 1))
+                os.replace(path, path_final)
+                save_index(path_final, img_ids, lengths)
+            n = sum(len(img_ids) for path, img_ids, lengths in written)
+            print("Finish! Adding {} samples in {} shards of {} {} set".format(n, len(written), layout, subset))
+
+
+def merge_tails(tails, path, rng):
+    """Rewrites the records of part-filled shards as shards of n_images_shard records and one last shorter one.
+
+    Records are drawn from the shards at random, in proportion to the records each has left, so the
+    merged shards mix the tails of all workers. Returns their paths, img_ids and record lengths.
+    """
+    readers = [tf.data.TFRecordDataset(shard[0], compression_type=compression).as_numpy_iterator() for shard in tails]
+    left = np.array([len(shard[1]) for shard in tails])
+    merged = []
+    writer = None
+    for n in range(left.sum()):
+        if n % n_images_shard == 0:
+            if writer is not None:
+                writer.close()
+            merged.append((path.format('merged-{:05d}'.format(len(merged))) + '.tmp', [], []))
+            writer = tf.io.TFRecordWriter(merged[-1][0], options=compression)
+        t = rng.choice(len(tails), p=left / left.sum())
+        example = next(readers[t])
+        writer.write(example)
+        merged[-1][1].append(tails[t][1][len(tails[t][1]) - left[t]])
+        merged[-1][2].append(len(example))
+        left[t] -= 1
+    if writer is not None:
+        writer.close()
+    for shard in tails:
+        os.remove(shard[0])
+    return merged
+
+
+def init_worker(*args):
+    global worker_args
+    worker_args = args
+
+
+def write_worker(worker):
+    """Writes the shards of the row chunks of one worker, returns their paths, img_ids and record lengths by set."""
+    raw_path, n_rows, label_index, subsets, scaler, store = worker_args
+    dataset = open_images(raw_path)
+    rng = np.random.default_rng(worker)
+    keys = [(layout, subset) for layout in layouts for subset in subsets]
+    tmp_path = {key: shard_path(*key).format('w{:03d}-{}'.format(worker, '{:05d}')) + '.tmp' for key in keys}
+    open_shards = {key: [None] * OPEN_SHARDS for key in keys}
+    shards = {key: [] for key in keys}
+    chunk_rows = block_size * CHUNK_BLOCKS
+
+    def close(key, slot):
+        shard = open_shards[key][slot]
+        shard['writer'].close()
+        shards[key].append((shard['path'], shard['img_ids'], shard['lengths']))
+        open_shards[key][slot] = None
+
+    # chunks, and the blocks of each chunk, are read in random order, so that shards do not follow the HDF5 rows
+    chunks = rng.permutation(range(worker * chunk_rows, n_rows, workers * chunk_rows))
+    blocks = ((first, block) for first in chunks for block in rng.permutation(range(first, min(first + chunk_rows, n_rows), block_size)))
+    try:
+        for c, (first, block) in enumerate(blocks):
+            if c % max(len(chunks) * CHUNK_BLOCKS // 10, 1) == 0:
+                print("Worker {} on row: {}".format(worker, first))
+            for key, img_id, example in get_examples(dataset, label_index, subsets, scaler, store, block,
+                                                     min(block + block_size, n_rows), False):
+                slot = rng.integers(OPEN_SHARDS)
+                if open_shards[key][slot] is None:
+                    path = tmp_path[key].format(len(shards[key]) + sum(s is not None for s in open_shards[key]))
+                    open_shards[key][slot] = {'writer': tf.io.TFRecordWriter(path, options=compression), 'path': path,
+                                              'img_ids': [], 'lengths': []}
+                shard = open_shards[key][slot]
+                shard['writer'].write(example)
+                shard['img_ids'].append(img_id)
+                shard['lengths'].append(len(example))
+                if len(shard['img_ids']) == n_images_shard:
+                    close(key, slot)
+    finally:
+        for key in keys:
+            for slot in range(OPEN_SHARDS):
+                if open_shards[key][slot] is not None:
+                    close(key, slot)
+        dataset.close()
+    if store is not None:
+        for array in store.values():
+            array.flush()
+    return shards
+
+
+def get_examples(dataset, label_index, subsets, scaler, store, first, last, verbose=True):
+    """Yields the (layout, subset), img_id and serialised example of every record of the labelled rows first to last."""
+    # a single scan of the HDF5 rows routes each labelled row to the sets of its subset in every layout
+    nr = 0
+    for block in read_blocks(dataset, label_index.img_ids, YEARS, block_size, first, last):
+        imgs = {year: crop_scale(block['img{}'.format(year)], scaler, CROP) for year in YEARS}
+        if store is not None:
+            # each image year is stored once, at the row of its img_id, and the records only refer to it
+            rows = [label_index.position[int(img_id)] for img_id in block['img_id']]
+            for year in YEARS:
+                store[year][rows] = quantize_image(imgs[year], image_format)
+        for i, img_id in enumerate(block['img_id']):
+            if verbose and (nr % 10000) == 0:
+                print ("On row: {}".format(nr))
+            nr += 1
+            img_id = int(img_id)
+            rec = label_index.lookup(img_id)
+            if rec['subset'] in subsets:
+                # the images and baseline features of a row are serialised once and shared by all layouts
+                images = {} if records == 'ids' else encode_images({year: imgs[year][i] for year in YEARS})
+                shared = get_shared(rec, label_index.cat_size)
+                for layout in layouts:
+                    for example in get_serialize(layout, images, shared, rec, img_id, block['lat'][i], block['lng'][i]):
+                        yield (layout, rec['subset']), img_id, example
+
+
+def _bytes_feature(value):
+    """Returns a bytes_list from a string / byte."""
+    if isinstance(value, tf.Tensor):
+        value = value.numpy() # BytesList won't unpack a string from an EagerTensor.
+    return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
+
+def _float_feature(value):
+    """Returns a float_list from a float / double."""
+    return tf.train.Feature(float_list=tf.train.FloatList(value=[value]))
+
+def _int64_feature(value):
+    """Returns an int64_list from a bool / enum / int / uint."""
+    return tf.train.Feature(int64_list=tf.train.Int64List(value=[value]))
+
+def _int64_list_feature(values):
+    """Returns an int64_list from a sequence of ints."""
+    return tf.train.Feature(int64_list=tf.train.Int64List(value=[int(v) for v in values]))
+
+
+def encode_images(imgs):
+    """Encodes the images of one row by year; mw images are split into their low and high resolution bands."""
+    if region == "national":
+        return {year: encode_image(img, image_format) for year, img in imgs.items()}
+    images = {}
+    for year, img in imgs.items():
+        images[('low', year)] = encode_image(img[:, :, 0:3], image_format)
+        images[('high', year)] = encode_image(img[:, :, 3:6], image_format)
+    return images
+
+
+def get_shared(rec, cat_size):
+    """Serialises the per-image features every layout repeats."""
+    if records != 'full':
+        return {}
+    shared = {'baseline_features': _bytes_feature(tf.make_tensor_proto(rec['features']).SerializeToString())}
+    if region == "national":
+        # county and state as the positions of the two ones of their one-hot vector, which
+        # data_loader.densify_categorical rebuilds for the consumers that want it dense
+        shared['categorical_values'] = _int64_list_feature(rec['cats'])
+        shared['categorical_size'] = _int64_feature(cat_size)
+    return shared
+
+
+def get_images(layout, images, year=None):
+    """Feature names and encoded images of one record of a layout."""
+    if records == 'ids':
+        return {}
+    if region == "national":
+        if layout == 'all':
+            return {'image': images[year]}
+        elif layout == 'diff':
+            return {'image0': images[0], 'image1': images[10]}
+        return {'image0': images[0], 'image10': images[10], 'image15': images[15]}
+    if layout == 'all':
+        return {'image_low': images[('low', year)], 'image_high': images[('high', year)]}
+    elif layout == 'diff':
+        return {'image_low_0': images[('low', 0)], 'image_high_0': images[('high', 0)],
+                'image_low_1': images[('low', 10)], 'image_high_1': images[('high', 10)]}
+    return {'image_low_0': images[('low', 0)], 'image_low_10': images[('low', 10)], 'image_low_15': images[('low', 15)],
+            'image_high_0': images[('high', 0)], 'image_high_10': images[('high', 10)], 'image_high_15': images[('high', 15)]}
+
+
+def get_labels(layout, rec, year=None):
+    """Feature names and values of the income and population labels of one record of a layout."""
+    if layout == 'all':
+        year = '00' if year == 0 else year
+        return {'inc': rec['log_inc_{}'.format(year)], 'pop': rec['log_pop_{}'.format(year)]}
+    elif layout == 'diff':
+        return {'inc0': rec['log_inc_00'], 'inc1': rec['log_inc_10'], 'pop0': rec['log_pop_00'], 'pop1': rec['log_pop_10']}
+    return {'inc0': rec['log_inc_00'], 'inc10': rec['log_inc_10'], 'inc15': rec['log_inc_15'],
+            'pop0': rec['log_pop_00'], 'pop10': rec['log_pop_10']}
+
+
+def serialize_example(images, img_id, labels, lat, lng, urban_share, pop_share, shared, year=None):
+    feature = {name: _bytes_feature(image) for name, image in images.items()}
+    feature['img_id'] = _int64_feature(img_id)
+    if records == 'full':
+        feature.update({name: _float_feature(value) for name, value in labels.items()})
+    feature['lat'] = _float_feature(lat)
+    feature['lng'] = _float_feature(lng)
+    if records == 'full':
+        feature['urban_share'] = _float_feature(urban_share)
+        feature['pop_share'] = _float_feature(pop_share)
+        feature.update(shared)
+    elif year is not None:
+        # the label sidecar holds every year, so levels records without labels say which one they show
+        feature['year'] = _int64_feature(year)
+    if image_format != 'float32' and records != 'ids':
+        feature['image_format'] = _int64_feature(IMAGE_FORMATS[image_format])
+    example_proto = tf.train.Example(features=tf.train.Features(feature=feature))
+    return example_proto.SerializeToString()
+
+def get_serialize(layout, images, shared, rec, img_id, lat, lng):
+    """Returns the serialised examples of one image in a layout, one per year in all and one otherwise."""
+    urban_share = rec['urban']
+    pop_share = rec['popshare_00']
+    if layout == 'all':
+        return [serialize_example(get_images(layout, images, year), img_id, get_labels(layout, rec, year),
+                                  lat, lng, urban_share, pop_share, shared, year) for year in LAYOUT_YEARS[layout]]
+    return [serialize_example(get_images(layout, images), img_id, get_labels(layout, rec),
+                              lat, lng, urban_share, pop_share, shared)]
+
+
+if __name__=="__main__":
+    main()
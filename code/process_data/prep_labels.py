@@ -0,0 +1,22 @@
+import os
+import sys
+from prep_utils import load_label_index, label_path
+
+ROOT = os.environ.get("CNN_PROJECT_ROOT", "../")
+
+# Rewrites only the label sidecar of shards prepped with records=images, so changing a label
+# definition or the feature scaling does not need a new prep and shard_data.py run.
+size = sys.argv[1] # small or large
+construct = sys.argv[2] # BG or block
+region = sys.argv[3] # national or mw
+
+
+def main():
+    label_index = load_label_index(ROOT, construct, size, region)
+    path = label_path(ROOT, construct, size, region)
+    label_index.save(path)
+    print("Complete! Wrote {} labels to {}".format(len(label_index), path))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,375 @@
+import json
+import os
+import sys
+import numpy as np
+import pandas as pd
+import tables
+import tensorflow as tf
+from sklearn import preprocessing
+
+# image encodings of the TFRecords; the int code is stored as 'image_format' when not float32
+IMAGE_FORMATS = {'float32': 0, 'uint16': 1, 'uint8': 2}
+
+FEATURES = ['log_pop_cnty_00', 'log_pop_cnty_10', 'log_pop_cnty_15',
+            'log_inc_cnty_00', 'log_inc_cnty_10', 'log_inc_cnty_15', 'area',
+            'image_coverage', 'white_00', 'black_00', 'hispanic_00', 'workage_00',
+            'female_00', 'groupshare_00', 'emp_sec1_00', 'emp_sec2_00',
+            'emp_sec3_00', 'emp_sec4_00', 'emp_sec5_00', 'emp_sec6_00',
+            'emp_sec7_00', 'emp_sec8_00', 'emp_sec9_00', 'emp_sec10_00',
+            'emp_sec11_00', 'emp_sec12_00', 'emp_sec13_00', 'emp_sec14_00',
+            'emp_sec15_00', 'emp_sec16_00', 'emp_sec17_00', 'emp_sec18_00',
+            'emp_sec19_00', 'emp_sec20_00', 'emp_bus_serv_00', 'emp_nonbus_serv_00',
+            'emp_prod_00', 'emp_bus_serv_cnty_00', 'emp_nonbus_serv_cnty_00',
+            'emp_prod_cnty_00']
+
+# record index of a shard, one row per record in file order
+INDEX_DTYPE = np.dtype([('img_id', '<i8'), ('offset', '<i8'), ('length', '<i8')])
+
+LABEL_COLUMNS = ['urban', 'popshare_00', 'log_inc_00', 'log_inc_10', 'log_inc_15',
+                 'log_pop_00', 'log_pop_10', 'log_pop_15']
+
+
+class LabelIndex:
+    """Label, baseline feature and categorical rows keyed by img_id.
+
+    Built once per prep run so that matching an HDF5 row to its label is a
+    single dict lookup instead of a boolean scan over the whole label table.
+    """
+
+    def __init__(self, label, scaled_features, categorical_values=None, categorical_size=0):
+        img_ids = label['img_id'].to_numpy().astype(np.int64)
+        if len(np.unique(img_ids)) != len(img_ids):
+            sys.exit('img_id is not unique in the label file')
+        self.img_ids = img_ids
+        self.position = dict(zip(img_ids.tolist(), range(len(img_ids))))
+        self.subset = label['subset'].to_numpy()
+        self.columns = {c: label[c].to_numpy().astype(np.float32) for c in LABEL_COLUMNS if c in label}
+        # scaled_features and categorical_values are aligned with label by position, not by index
+        features = np.concatenate((scaled_features.loc[:, ['log_pop_cnty_00', 'log_inc_cnty_00']],
+                                   scaled_features.loc[:, 'white_00':]), axis=-1)
+        self.features = features.astype(np.float32)
+        self.cats = None if categorical_values is None else np.asarray(categorical_values, dtype=np.int64)
+        self.cat_size = int(categorical_size)
+
+    def __len__(self):
+        return len(self.position)
+
+    def lookup(self, img_id):
+        """Returns all label fields of img_id in one dict, or None if it has no label."""
+        pos = self.position.get(int(img_id))
+        if pos is None:
+            return None
+        rec = {c: values[pos] for c, values in self.columns.items()}
+        rec['subset'] = self.subset[pos]
+        rec['features'] = self.features[pos:pos + 1]
+        if self.cats is not None:
+            rec['cats'] = self.cats[pos]
+        return rec
+
+    def save(self, path):
+        """Writes the labels as a label sidecar, the .npz data_loader.load_labels joins on img_id.
+
+        inc and pop hold the 2000, 2010 and 2015 values in their three columns, NaN where the
+        label file has none; the keys otherwise follow the names of the full TFRecords.
+        """
+        missing = np.full(len(self.img_ids), np.nan, dtype=np.float32)
+        sidecar = {
+            'img_id': self.img_ids,
+            'subset': self.subset.astype(str),
+            'inc': np.stack([self.columns.get('log_inc_{}'.format(y), missing) for y in ['00', '10', '15']], -1),
+            'pop': np.stack([self.columns.get('log_pop_{}'.format(y), missing) for y in ['00', '10', '15']], -1),
+            'urban_share': self.columns['urban'],
+            'pop_share': self.columns['popshare_00'],
+            'baseline_features': self.features
+        }
+        if self.cats is not None:
+            sidecar['categorical_values'] = self.cats
+            sidecar['categorical_size'] = np.int64(self.cat_size)
+        # np.savez appends .npz to names without it, so write the temporary file under a .npz name too
+        np.savez(path + '.tmp.npz', **sidecar)
+        os.replace(path + '.tmp.npz', path)
+
+
+def label_path(root, construct, size, region):
+    """Path of the label sidecar of a prep configuration."""
+    return f'{root}/temp/{construct}_{size}_{region}_labels.npz'
+
+
+def load_label_index(root, construct, size, region):
+    """Reads the label file of a prep configuration, drops incomplete rows and scales the baseline features."""
+    label = pd.read_csv(f'{root}/temp/{construct}cw_labelled_imgs_{region}_{size}.csv')
+    label = label[~label['log_inc_10'].isnull()]
+    label = label[~label['log_inc_00'].isnull()]
+    label = label[~label['log_inc_15'].isnull()]
+    if construct == 'BG':
+        label = label[~label['log_pop_15'].isnull()]
+    label = label[~label['log_pop_00'].isnull()]
+    label = label[~label['log_pop_10'].isnull()]
+    label = label[~label['popshare_00'].isnull()]
+    label = label[~label['urban'].isnull()]
+    label = label[label['sample']==1]
+
+    features = label.loc[:,FEATURES]
+    min_max_scaler = preprocessing.MinMaxScaler()
+    min_max_scaler.fit(features)
+    scaled_features = pd.DataFrame(min_max_scaler.transform(features), columns=features.columns)
+
+    categorical_values, categorical_size = categorical_codes(label)
+    return LabelIndex(label, scaled_features, categorical_values, categorical_size)
+
+
+def categorical_codes(label):
+    """County and state of each label row as the positions of their ones in the one-hot vector
+    pd.get_dummies(label, columns=['county', 'state']) builds, and the width of that vector.
+
+    Positions are -1 where county or state is missing, which one-hot encodes to all zeros.
+    """
+    county, counties = pd.factorize(label['county'], sort=True)
+    state, states = pd.factorize(label['state'], sort=True)
+    state = np.where(state >= 0, state + len(counties), -1)
+    return np.stack([county, state], -1).astype(np.int64), len(counties) + len(states)
+
+
+def by_year_path(raw_path):
+    """Path of the per-year copy (split_years.py) of a raw HDF5 image file."""
+    return raw_path[:-len('_raw.h5')] + '_by_year.h5'
+
+
+def open_images(raw_path):
+    """Opens the per-year copy of an image file if it exists, otherwise the raw file.
+
+    Exits if the raw file was written after the copy or holds another number of rows, since the copy
+    would miss its changes; the copy is used on its own when download_data.py wrote no raw file.
+    """
+    copy_path = by_year_path(raw_path)
+    if not os.path.exists(copy_path):
+        return tables.open_file(raw_path)
+    dataset = tables.open_file(copy_path)
+    if os.path.exists(raw_path):
+        with tables.open_file(raw_path) as raw:
+            n_raw = count_rows(raw)
+        if n_raw != count_rows(dataset) or os.path.getmtime(raw_path) > os.path.getmtime(copy_path):
+            dataset.close()
+            sys.exit('{} changed after split_years.py copied it to {}, pls rerun split_years.py'.format(raw_path, copy_path))
+    return dataset
+
+
+def write_by_year(raw, out_path, block_size, chunk_images=1, complevel=0):
+    """Copies the records of an open raw image file into one array per field of out_path, so one per year.
+
+    Each HDF5 chunk holds chunk_images images; with complevel > 0 the chunks are Blosc/LZ4 compressed.
+    """
+    out = tables.open_file(out_path, mode="w")
+    filters = tables.Filters(complevel=complevel, complib='blosc:lz4', shuffle=True) if complevel > 0 else None
+    arrays = {}
+    for node in raw.root:
+        print("Splitting {} rows of {}".format(node.nrows, node._v_pathname))
+        for f in node.colnames:
+            if f not in arrays:
+                dtype = node.coldtypes[f]
+                chunkshape = (chunk_images,) + dtype.shape if dtype.shape else None
+                arrays[f] = out.create_earray('/', f, tables.Atom.from_dtype(dtype.base), (0,) + dtype.shape,
+                                              expectedrows=node.nrows, chunkshape=chunkshape, filters=filters)
+        for start in range(0, node.nrows, block_size):
+            rows = node.read(start, min(start + block_size, node.nrows))
+            for f in node.colnames:
+                arrays[f].append(rows[f])
+    out.close()
+
+
+def read_years(dataset, years, first=0, last=None):
+    """Reads img_id, lat, lng and the images of years in file rows first to last of a raw or per-year image file.
+
+    Only the arrays of those years are read from a per-year file; a raw record holds every year,
+    so from a raw file full rows are read and the other years dropped.
+    """
+    fields = ['img_id', 'lat', 'lng'] + ['img{}'.format(year) for year in years]
+    if last is None:
+        last = count_rows(dataset)
+    if '/img_id' in dataset:
+        return {f: dataset.get_node('/' + f).read(first, last) for f in fields}
+    blocks = []
+    offset = 0
+    for node in dataset.root:
+        start, stop = max(first - offset, 0), min(last - offset, node.nrows)
+        if start < stop:
+            blocks.append(node.read(start, stop))
+        offset += node.nrows
+    return {f: np.concatenate([block[f] for block in blocks]) for f in fields}
+
+
+def labelled_coordinates(file_img_ids, img_ids):
+    """Row numbers of the image rows whose img_id is in img_ids, in file order."""
+    return np.nonzero(np.isin(file_img_ids, img_ids))[0]
+
+
+def read_runs(array, rows):
+    """Reads the increasing row numbers rows of an HDF5 array, one contiguous run at a time."""
+    runs = np.split(rows, np.nonzero(np.diff(rows) != 1)[0] + 1)
+    return np.concatenate([array[run[0]:run[-1] + 1] for run in runs])
+
+
+def count_rows(dataset):
+    """Number of image rows of a raw or per-year image file."""
+    if '/img_id' in dataset:
+        return int(dataset.root.img_id.nrows)
+    return int(sum(node.nrows for node in dataset.root))
+
+
+def image_shape(dataset, year, crop):
+    """Shape of the images of a year of a raw or per-year image file once crop_scale has stripped crop pixels off each side."""
+    if '/img_id' in dataset:
+        shape = dataset.get_node('/img{}'.format(year)).shape[1:]
+    else:
+        shape = next(iter(dataset.root)).coldescrs['img{}'.format(year)].shape
+    return (int(shape[0]) - 2 * crop, int(shape[1]) - 2 * crop, int(shape[2]))
+
+
+def read_blocks(dataset, img_ids, years, block_size, first=0, last=None):
+    """Reads the images of img_ids in file rows first to last, block_size rows at a time.
+
+    Yields dicts holding img_id, lat, lng and one image array per requested year.
+    In the per-year layout only the arrays of those years are read; the raw layout
+    from download_data.py stores all years in one record, so full rows are read.
+    """
+    fields = ['img_id', 'lat', 'lng'] + ['img{}'.format(year) for year in years]
+    if last is None:
+        last = count_rows(dataset)
+    if '/img_id' in dataset:
+        coords = labelled_coordinates(dataset.root.img_id.read(first, last), img_ids) + first
+        for start in range(0, len(coords), block_size):
+            block = coords[start:start + block_size]
+            yield {f: read_runs(dataset.get_node('/' + f), block) for f in fields}
+    else:
+        # img_id is stored inside each record here, so finding the labelled rows up front would
+        # cost a full extra pass; read contiguous blocks and drop the unlabelled rows instead
+        offset = 0
+        for node in dataset.root:
+            buffer = np.empty(block_size, dtype=node.dtype)
+            node_last = min(last - offset, node.nrows)
+            for start in range(max(first - offset, 0), node_last, block_size):
+                stop = min(start + block_size, node_last)
+                rows = buffer[:stop - start]
+                node.read(start, stop, out=rows)
+                labelled = np.isin(rows['img_id'], img_ids)
+                if labelled.any():
+                    yield {f: rows[f][labelled] for f in fields}
+            offset += node.nrows
+
+
+def load_manifest(path, config):
+    """Reads the progress manifest of a partitioned prep run, or starts one for config.
+
+    Exits if the manifest was written by a run with other arguments, whose parts would not fit together.
+    """
+    if not os.path.exists(path):
+        return {'config': config, 'parts': {}}
+    with open(path) as fh:
+        manifest = json.load(fh)
+    if manifest['config'] != config:
+        sys.exit('{} was written with other arguments, delete it and its parts to start over'.format(path))
+    return manifest
+
+
+def save_manifest(path, manifest):
+    """Writes the progress manifest so that a crash while writing never leaves a truncated file."""
+    with open(path + '.tmp', 'w') as fh:
+        json.dump(manifest, fh, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+def crop_scale(imgs, scaler, crop):
+    """Strips the GEE kernel overlap from a block of images and divides by the top codes."""
+    return imgs[:, crop:-crop, crop:-crop, :].astype(np.float32) / scaler
+
+
+def quantize_image(img, image_format):
+    """Top-coded images in the given format.
+
+    float32 keeps the unclipped values; uint16 and uint8 hold the [0, 1] clipped values as
+    little-endian integers scaled to the full type range.
+    """
+    if image_format == 'float32':
+        return img
+    elif image_format == 'uint16':
+        return np.round(np.clip(img, 0, 1) * 65535).astype('<u2')
+    elif image_format == 'uint8':
+        return np.round(np.clip(img, 0, 1) * 255).astype(np.uint8)
+    else:
+        sys.exit('invalid image_format')
+
+
+def encode_image(img, image_format):
+    """Serialises a top-coded image in the given format.
+
+    float32 keeps the serialize_tensor encoding the loaders have always read, built as a TensorProto
+    so that no TensorFlow op runs (prep_data.py forks its workers); uint16 and uint8 are the raw bytes
+    of quantize_image.
+    """
+    if image_format == 'float32':
+        return tf.make_tensor_proto(img).SerializeToString()
+    return quantize_image(img, image_format).tobytes()
+
+
+def image_store_path(root, construct, size, region):
+    """Directory of the image store of a prep configuration."""
+    return f'{root}/temp/{construct}_{size}_{region}_images'
+
+
+def open_image_store(path, img_ids, years, shape, image_format):
+    """Opens the per-year image arrays of an image store for writing, creating them where needed.
+
+    Row i of every array holds the image of img_ids[i], so each image is stored once however many
+    layouts refer to it. Arrays of another shape or format, or of another img_id order, are replaced.
+    """
+    os.makedirs(path, exist_ok=True)
+    id_path = os.path.join(path, 'img_id.npy')
+    keep = os.path.exists(id_path) and np.array_equal(np.load(id_path), img_ids)
+    if not keep:
+        np.save(id_path, img_ids)
+    dtype = np.dtype({'float32': np.float32, 'uint16': '<u2', 'uint8': np.uint8}[image_format])
+    store = {}
+    for year in years:
+        year_path = os.path.join(path, 'img{}.npy'.format(year))
+        if keep and os.path.exists(year_path):
+            store[year] = np.lib.format.open_memmap(year_path, mode='r+')
+            if store[year].shape[1:] == shape and store[year].dtype == dtype:
+                continue
+            del store[year]
+        store[year] = np.lib.format.open_memmap(year_path, mode='w+', dtype=dtype, shape=(len(img_ids),) + shape)
+    return store
+
+
+def index_path(shard_path):
+    """Path of the record index written next to a shard."""
+    return shard_path[:-len('.tfrecords')] + '.index.npy'
+
+
+def save_index(shard_path, img_ids, lengths):
+    """Writes the record index of a shard: the img_id, data offset and data length of each record, in file order.
+
+    Each TFRecord frames its data with a 12 byte header and a 4 byte footer; offsets count bytes of the
+    uncompressed record stream, so they are file offsets unless the shard is compressed.
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    index = np.empty(len(lengths), dtype=INDEX_DTYPE)
+    index['img_id'] = img_ids
+    index['length'] = lengths
+    index['offset'] = np.cumsum(lengths + 16) - lengths - 4
+    # np.save appends .npy to names without it, so write the temporary file under a .npy name too
+    np.save(index_path(shard_path) + '.tmp.npy', index)
+    os.replace(index_path(shard_path) + '.tmp.npy', index_path(shard_path))
+
+
+# copied to train_test_models/utils.py for the loaders, which do not import this module; keep the two in step
+def get_compression_type(path):
+    """Returns the TFRecord compression type ('', 'GZIP' or 'ZLIB') the file at path was written with."""
+    for compression_type in ['', 'GZIP', 'ZLIB']:
+        try:
+            for _ in tf.data.TFRecordDataset(path, compression_type=compression_type).take(1):
+                pass
+            return compression_type
+        except tf.errors.DataLossError:
+            continue
+    sys.exit('{} is not a TFRecord file'.format(path))
+
@@ -1,8 +1,13 @@
 import os
 os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
 import tensorflow as tf
+import glob
+import json
+import numpy as np
+import pandas as pd
 import sys
 from tqdm import tqdm
+from prep_utils import get_compression_type, index_path, save_index
 # physical_devices = tf.config.experimental.list_physical_devices('GPU')
 # tf.config.experimental.set_memory_growth(physical_devices[0], True)
 # tf.config.threading.set_inter_op_parallelism_threads(1)
@@ -13,37 +18,213 @@ size = sys.argv[1]
 construct = sys.argv[2] # BG or block
 model = sys.argv[3] # all or diff
 n_images_shard = int(sys.argv[4])
-region = sys.argv[5] # national or mw 
-train = tf.data.TFRecordDataset('{}/temp/train_{}_{}_{}_{}.tfrecords'.format(ROOT, construct, size, model, region))
-valid = tf.data.TFRecordDataset('{}/temp/validation_{}_{}_{}_{}.tfrecords'.format(ROOT, construct, size, model, region))
-test = tf.data.TFRecordDataset('{}/temp/test_{}_{}_{}_{}.tfrecords'.format(ROOT, construct, size, model, region))
+region = sys.argv[5] # national or mw
+memory_mb = int(sys.argv[6]) if len(sys.argv) > 6 else 2048 # ceiling on the records held in memory while shuffling
+partition = sys.argv[7] if len(sys.argv) > 7 else '' # '', state or grid: every shard then holds one state or grid cell
+in_path = '{}/temp/{}_{}_{}_{}_{}.tfrecords'.format(ROOT, '{}', construct, size, model, region)
+part_path = '{}/temp/{}_{}_{}_{}_{}-part*.tfrecords'.format(ROOT, '{}', construct, size, model, region)
+READ_BATCH = 64
+GRID_DEG = 2 # side of the lat/lng cells of partition=grid
+POSITION = {
+    'img_id': tf.io.FixedLenFeature((), tf.int64),
+    'lat': tf.io.FixedLenFeature((), tf.float32),
+    'lng': tf.io.FixedLenFeature((), tf.float32)
+}
+if partition not in ['', 'state', 'grid']:
+    sys.exit('invalid partition')
+
+
+def in_files(subset):
+    # prep runs with part_rows write their output in parts instead of one file
+    if os.path.exists(in_path.format(subset)):
+        return [in_path.format(subset)]
+    files = sorted(tf.io.gfile.glob(part_path.format(subset)))
+    if len(files) == 0:
+        sys.exit('no {} prep output in {}/temp'.format(subset, ROOT))
+    return files
+
+
+# shards keep the compression the prep scripts wrote the files with
+compression = get_compression_type(in_files('train')[0])
 if not os.path.exists('{}/temp/{}_{}_{}_{}'.format(ROOT, size, construct, model, region)):
     os.makedirs('{}/temp/{}_{}_{}_{}'.format(ROOT, size, construct, model, region))
 out_dir = '{}/temp/{}_{}_{}_{}/{}_{}_{}_{}_{}_{}.tfrecords'.format(ROOT, size, construct, model, region, '{}', construct, size, model, region, '{}')
+if partition == 'state':
+    label = pd.read_csv(f'{ROOT}/temp/{construct}cw_labelled_imgs_{region}_{size}.csv', usecols=['img_id', 'state'])
+    states = dict(zip(label['img_id'], label['state']))
 
 
 def main():
-    make_shard(train, n_images_shard, out_dir.format('train', '{}'))
-    make_shard(valid, n_images_shard, out_dir.format('validation', '{}'))
-    make_shard(test, n_images_shard, out_dir.format('test', '{}'))
+    make_shard(in_files('train'), n_images_shard, out_dir.format('train', '{}'))
+    make_shard(in_files('validation'), n_images_shard, out_dir.format('validation', '{}'))
+    make_shard(in_files('test'), n_images_shard, out_dir.format('test', '{}'))
     print('Finish!')
 
 
-def ds_len(ds):
-    return len(list(ds.map(lambda x: 1, num_parallel_calls=tf.data.experimental.AUTOTUNE)))
+def scatter(batches, n_buckets, bucket_path, rng):
+    """Writes batches of records to n_buckets uncompressed temporary files, each record to one at random.
+
+    Returns the bucket paths and the number of records of each.
+    """
+    paths = [bucket_path.format(i) for i in range(n_buckets)]
+    writers = [tf.io.TFRecordWriter(path) for path in paths]
+    lengths = [0] * n_buckets
+    try:
+        for batch in batches:
+            for record, bucket in zip(batch, rng.integers(n_buckets, size=len(batch))):
+                writers[bucket].write(record)
+                lengths[bucket] += 1
+    finally:
+        for writer in writers:
+            writer.close()
+    return paths, lengths
+
+
+def partition_keys(position):
+    """Partition keys of a batch of records from their img_id, lat and lng, e.g. s06 or g+34-120."""
+    if partition == 'state':
+        return ['sNA' if pd.isnull(states.get(img_id)) else 's{:02d}'.format(int(states[img_id])) for img_id in position['img_id']]
+    lat = (np.floor(position['lat'] / GRID_DEG) * GRID_DEG).astype(int)
+    lng = (np.floor(position['lng'] / GRID_DEG) * GRID_DEG).astype(int)
+    return ['g{:+d}{:+d}'.format(a, b) for a, b in zip(lat, lng)]
+
+
+def scatter_partitions(batches, bucket_path):
+    """Writes batches of records and their positions to one uncompressed temporary file per partition key.
+
+    Returns the bucket path and the number of records of every key.
+    """
+    writers, paths, lengths = {}, {}, {}
+    try:
+        for batch, position in batches:
+            for record, key in zip(batch, partition_keys(position)):
+                if key not in writers:
+                    paths[key] = bucket_path.format(key)
+                    writers[key] = tf.io.TFRecordWriter(paths[key])
+                    lengths[key] = 0
+                writers[key].write(record)
+                lengths[key] += 1
+    finally:
+        for writer in writers.values():
+            writer.close()
+    return paths, lengths
+
+
+def n_buckets(nbytes):
+    # twice as many buckets as the bytes need, so that random bucket sizes rarely go over the ceiling
+    return max(int(np.ceil(2 * nbytes / (memory_mb * 2 ** 20))), 1)
+
+
+def read_batches(files, compression_type):
+    """Batches of the records of files, with the img_id, lat and lng of each."""
+    ds = tf.data.TFRecordDataset(files, compression_type=compression_type).batch(READ_BATCH)
+    return ds.map(lambda x: (x, tf.io.parse_example(x, POSITION))).as_numpy_iterator()
 
 
-def make_shard(ds, n_image_shards, output_path):
-    length = ds_len(ds)
-    n_shards = int(length / n_images_shard) + (1 if length % n_image_shards != 0 else 0)
+def read_bucket(path):
+    """Records of a bucket file and their img_id, lat and lng."""
+    records, positions = [], []
+    for batch, position in read_batches(path, ''):
+        records.extend(batch)
+        positions.append(position)
+    if len(records) == 0:
+        return records, None
+    return records, {k: np.concatenate([p[k] for p in positions]) for k in POSITION}
+
+
+def manifest_path(output_path):
+    """Path of the shard manifest of a set."""
+    return output_path.format('manifest')[:-len('.tfrecords')] + '.json'
+
+
+class ShardWriter:
+    """Writes a shard and, when closed, its record index (prep_utils.save_index)."""
+
+    def __init__(self, path, key):
+        self.path = path
+        self.key = key
+        self.writer = tf.io.TFRecordWriter(path, options=compression)
+        self.img_ids, self.lengths, self.lats, self.lngs = [], [], [], []
+
+    def write(self, record, img_id, lat, lng):
+        self.writer.write(record)
+        self.img_ids.append(img_id)
+        self.lengths.append(len(record))
+        self.lats.append(lat)
+        self.lngs.append(lng)
+
+    def close(self):
+        """Closes the shard and returns its manifest entry: partition key, records and lat/lng bounding box."""
+        self.writer.close()
+        save_index(self.path, self.img_ids, self.lengths)
+        bbox = [float(min(self.lats)), float(min(self.lngs)), float(max(self.lats)), float(max(self.lngs))]
+        return {os.path.basename(self.path): {'key': self.key, 'n': len(self.img_ids), 'bbox': bbox}}
+
+
+def write_shards(buckets, lengths, n_image_shards, output_path, rng, manifest, key=None):
+    """Shuffles the records of buckets, one bucket at a time, into shards of n_image_shards records.
+
+    lengths holds the number of records of each bucket.
+    """
+    length = sum(lengths)
+    n_shards = int(length / n_image_shards) + (1 if length % n_image_shards != 0 else 0)
     n = 0
-    for shard in tqdm(ds.shuffle(length).batch(n_images_shard).as_numpy_iterator()):
-        tfrecords_shard_path = output_path.format('%.5d-of-%.5d' % (n, n_shards - 1))
-        n += 1
-        with tf.io.TFRecordWriter(tfrecords_shard_path) as writer:
-            for row in shard:
-                writer.write(row)
+    writer = None
+    with tqdm(total=length) as progress:
+        while len(buckets) > 0:
+            bucket = buckets.pop(0)
+            bucket_length = lengths.pop(0)
+            nbytes = os.path.getsize(bucket)
+            if nbytes > memory_mb * 2 ** 20 and bucket_length > 1:
+                # a large partition, or compressed input holding more than its size on disk suggests;
+                # split the bucket at random once more. A single record over the ceiling is written as it is
+                batches = (batch for batch, position in read_batches(bucket, ''))
+                split, split_lengths = scatter(batches, n_buckets(nbytes), bucket.replace('.tfrecords.tmp', '-{}.tfrecords.tmp'), rng)
+                buckets = split + buckets
+                lengths = split_lengths + lengths
+                os.remove(bucket)
+                continue
+            records, position = read_bucket(bucket)
+            os.remove(bucket)
+            for i in rng.permutation(len(records)):
+                if n % n_image_shards == 0:
+                    if writer is not None:
+                        manifest['shards'].update(writer.close())
+                    writer = ShardWriter(output_path.format('%.5d-of-%.5d' % (n // n_image_shards, n_shards - 1)), key)
+                writer.write(records[i], *(position[k][i] for k in POSITION))
+                n += 1
+            progress.update(len(records))
+    if writer is not None:
+        manifest['shards'].update(writer.close())
+
+
+def make_shard(files, n_image_shards, output_path):
+    """Writes the records of files in random order as shards of n_image_shards records, each with its record index.
+
+    A two-pass external shuffle, so memory holds one bucket rather than the whole set: the records are
+    scattered at random over temporary buckets, then each bucket is shuffled in memory and appended to
+    the shards. Concatenating buckets shuffled this way gives a uniformly random order. With a partition,
+    the records are scattered by partition key instead and every key gets shards of its own. The shards
+    are listed in a manifest with their key and bounding box, which read_files can select shards by.
+    """
+    rng = np.random.default_rng()
+    # shards of an earlier run with another shard count would be globbed along with the new ones
+    for path in glob.glob(output_path.format('*-of-*')) + glob.glob(index_path(output_path.format('*-of-*'))):
+        os.remove(path)
+    batches = tqdm(read_batches(files, compression))
+    manifest = {'partition': partition, 'shards': {}}
+    if partition == '':
+        buckets, lengths = scatter((batch for batch, position in batches), n_buckets(sum(os.path.getsize(f) for f in files)),
+                                  output_path.format('bucket{}') + '.tmp', rng)
+        write_shards(buckets, lengths, n_image_shards, output_path, rng, manifest)
+    else:
+        buckets, lengths = scatter_partitions(batches, output_path.format('bucket-{}') + '.tmp')
+        for key in sorted(buckets):
+            write_shards([buckets[key]], [lengths[key]], n_image_shards, output_path.format(key + '-{}'), rng, manifest, key)
+    with open(manifest_path(output_path) + '.tmp', 'w') as fh:
+        json.dump(manifest, fh, indent=1)
+    os.replace(manifest_path(output_path) + '.tmp', manifest_path(output_path))
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
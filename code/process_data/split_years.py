@@ -0,0 +1,35 @@
+import os
+import sys
+import tables
+from prep_utils import by_year_path, write_by_year
+
+ROOT = os.environ.get("CNN_PROJECT_ROOT", "../")
+
+# Rewrites a raw image file from download_data.py (one record holding every year) into one array
+# per year, so the prep scripts only read the years they serialise.
+size = sys.argv[1] # small or large
+region = sys.argv[2] # national or mw
+block_size = int(sys.argv[3]) if len(sys.argv) > 3 else 64 # HDF5 rows copied per block
+# images per HDF5 chunk; the default of one image per chunk means reading any subset of rows never drags in
+# neighbours, while larger chunks compress better and suit reading whole years
+chunk_images = int(sys.argv[4]) if len(sys.argv) > 4 else 1
+complevel = int(sys.argv[5]) if len(sys.argv) > 5 else 0 # Blosc/LZ4 compression level, 0 for none
+
+
+def main():
+    if region == "mw":
+        raw_path = f"{ROOT}/temp/high_resolution_small_images_raw.h5"
+    elif region == "national":
+        raw_path = f"{ROOT}/temp/{size}_images_all_years_raw.h5"
+    else:
+        sys.exit('invalid region')
+    out_path = by_year_path(raw_path)
+    raw = tables.open_file(raw_path)
+    write_by_year(raw, out_path + '.tmp', block_size, chunk_images, complevel)
+    raw.close()
+    os.replace(out_path + '.tmp', out_path)
+    print("Complete! Wrote {}".format(out_path))
+
+
+if __name__ == "__main__":
+    main()
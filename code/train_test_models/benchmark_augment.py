@@ -0,0 +1,61 @@
+import os
+os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
+import time
+from data_loader import *
+
+# Compares the throughput of the per-example augmentation of data_process_train and data_process_diff_train
+# with the map they replaced (central_crop -> resize -> pad -> random_crop, with one crop fraction for every
+# batch), on a random batch held in memory.
+# Usage: python benchmark_augment.py [size] [bs] [n_batches]
+size = sys.argv[1] if len(sys.argv) > 1 else 'large'  # ['large', 'small']
+bs = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+n_batches = int(sys.argv[3]) if len(sys.argv) > 3 else 200
+
+
+def previous_process_train(image, img_size, img_augmented_size, n_bands, flip=True):
+    fraction = float(np.random.uniform(0.90, 1.0))
+    if flip:
+        image = tf.image.random_flip_left_right(image)
+    image = tf.image.central_crop(image, fraction)
+    image = tf.image.resize(image, [img_size, img_size])
+    image = tf.image.resize_with_crop_or_pad(image, img_augmented_size, img_augmented_size)
+    return tf.image.random_crop(image, size=[tf.shape(image)[0], img_size, img_size, n_bands])
+
+
+def examples_per_second(process, *args):
+    # the batch is an argument rather than a constant, which grappler would fold the deterministic ops into
+    process = tf.function(process)
+    process(*args)
+    # the best of three runs is the least disturbed by other load
+    seconds = []
+    for _ in range(3):
+        start = time.time()
+        for _ in range(n_batches):
+            process(*args)
+        seconds.append(time.time() - start)
+    return n_batches * bs / min(seconds)
+
+
+def main():
+    img_size, img_augmented_size, _, n_bands, _ = get_img_size(size, 'base', 'national', 'low')
+    image0 = tf.random.uniform([bs, img_size, img_size, n_bands])
+    image1 = tf.random.uniform([bs, img_size, img_size, n_bands])
+    seed = tf.constant([0, 0], tf.int64)
+    print("{} images, batches of {}".format(size, bs))
+    print("{:<10} {:>18} {:>18}".format('', 'previous ex/s', 'batched ex/s'))
+    previous = examples_per_second(lambda x: previous_process_train(x, img_size, img_augmented_size, n_bands), image0)
+    batched = examples_per_second(
+        lambda x, seed: data_process_train(x, None, None, img_size, img_augmented_size, False, seed), image0, seed)
+    print("{:<10} {:>18.1f} {:>18.1f}".format('level', previous, batched))
+    # the diff map cropped each image of a pair on its own, without flips
+    previous = examples_per_second(lambda x, y: (previous_process_train(x, img_size, img_augmented_size, n_bands, False),
+                                                 previous_process_train(y, img_size, img_augmented_size, n_bands, False)),
+                                   image0, image1)
+    batched = examples_per_second(
+        lambda x, y, seed: data_process_diff_train(x, y, None, None, img_size, img_augmented_size, False, seed),
+        image0, image1, seed)
+    print("{:<10} {:>18.1f} {:>18.1f}".format('diff', previous, batched))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+import os
+os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
+import glob
+import time
+from data_loader import *
+
+# Compares the per-record decode path (tf.io.parse_single_example, as decode and decode_diff do) with the
+# batched one (tf.io.parse_example, as decode_batch and decode_diff_batch do) on one core, for the level,
+# diff and prediction records of a prep run. The records are held in memory, so only decoding is timed.
+# Usage: python benchmark_decode.py construct region size data_dir [subset]
+construct = sys.argv[1]  # BG or block
+region = sys.argv[2]  # ['national', 'mw']
+size = sys.argv[3]  # ['large', 'small']
+data_dir = sys.argv[4]  # ../temp of a prep run
+subset = sys.argv[5] if len(sys.argv) > 5 else 'validation'
+N_EPOCHS = 3
+
+tf.config.threading.set_intra_op_parallelism_threads(1)
+tf.config.threading.set_inter_op_parallelism_threads(1)
+
+
+def decode_record(serialized_example, feature_description, keys, img_size, n_origin_bands):
+    example = tf.io.parse_single_example(serialized_example, feature_description)
+    return [decode_image(example, key, img_size, n_origin_bands) for key in keys] + [parse_features(example)]
+
+
+def decode_records(serialized_examples, feature_description, keys, img_size, n_origin_bands):
+    example = tf.io.parse_example(serialized_examples, feature_description)
+    return [decode_image_batch(example, key, img_size, n_origin_bands) for key in keys] + [parse_features_batch(example)]
+
+
+def examples_per_second(ds):
+    options = tf.data.Options()
+    options.threading.private_threadpool_size = 1
+    ds = ds.with_options(options)
+    # the first pass warms up tracing
+    for _ in ds:
+        pass
+    start = time.time()
+    for _ in range(N_EPOCHS):
+        for _ in ds:
+            pass
+    return time.time() - start
+
+
+def main():
+    model_type = 'RGB' if region == 'mw' else 'base'
+    resolution = 'high' if region == 'mw' else 'low'
+    img_size, _, n_origin_bands, _, _ = get_img_size(size, model_type, region, resolution)
+    print("{:<12} {:>10} {:>20} {:>20} {:>8}".format('records', 'examples', 'per-record ex/s', 'batched ex/s', 'speedup'))
+    prefix = 'mw_' if region == 'mw' else ''
+    for layout, feature_type in [('all', prefix + 'level'), ('diff', prefix + 'diff'), ('15', 'mw_15' if region == 'mw' else 'test')]:
+        files = sorted(glob.glob('{}/{}_{}_{}_{}/{}_{}_{}_{}_{}_*-of-*.tfrecords'
+                                 .format(data_dir, size, construct, layout, region, subset, construct, size, layout, region)))
+        if len(files) == 0:
+            continue
+        feature_description = get_feature_description(feature_type)
+        keys = [k for k in feature_description if k.startswith('image') and k != 'image_format']
+        records = tf.data.TFRecordDataset(files, compression_type=get_compression_type(files[0])).cache()
+        n = sum(1 for _ in records)
+        per_record = examples_per_second(
+            records.map(lambda x: decode_record(x, feature_description, keys, img_size, n_origin_bands)))
+        batched = examples_per_second(
+            records.batch(DECODE_BATCH).map(lambda x: decode_records(x, feature_description, keys, img_size, n_origin_bands)))
+        print("{:<12} {:>10} {:>20.1f} {:>20.1f} {:>7.1f}x".format(
+            feature_type, n, n * N_EPOCHS / per_record, n * N_EPOCHS / batched, per_record / batched))
+
+
+if __name__ == "__main__":
+    main()
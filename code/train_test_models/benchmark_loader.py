@@ -0,0 +1,42 @@
+import os
+os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
+import glob
+import time
+from data_loader import *
+
+# Compares shards of the same images written with different image formats or compression,
+# e.g. prep runs with CNN_PROJECT_ROOT pointing at one directory per format.
+# Usage: python benchmark_loader.py construct region size subset data_dir [data_dir ...]
+construct = sys.argv[1]  # BG or block
+region = sys.argv[2]  # ['national', 'mw']
+size = sys.argv[3]  # ['large', 'small']
+subset = sys.argv[4]  # ['train', 'validation', 'test']
+data_dirs = sys.argv[5:]  # ../temp of each prep run
+BS = 64
+N_EPOCHS = 3
+
+
+def main():
+    model_type = 'RGB' if region == 'mw' else 'base'
+    resolution = 'high' if region == 'mw' else 'low'
+    print("{:<40} {:>10} {:>12} {:>12} {:>14}".format('data_dir', 'examples', 'MB on disk', 'bytes/ex', 'examples/s'))
+    for data_dir in data_dirs:
+        ds_dir = '{}/{}_{}_{}_{}/{}_{}_{}_{}_{}_*-of-*.tfrecords' \
+            .format(data_dir, size, construct, '{}', region, '{}', construct, size, '{}', region)
+        files = glob.glob(ds_dir.format('all', subset, 'all'))
+        if len(files) == 0:
+            sys.exit('no shards in {}'.format(data_dir))
+        nbytes = sum(os.path.getsize(f) for f in files)
+        ds = get_dataset(ds_dir, size, 'inc', model_type, False, BS, 'merged', region, resolution, subset)
+        # the first pass warms up tracing and the page cache
+        n = sum(int(tf.shape(y)[0]) for _, y in ds)
+        start = time.time()
+        for _ in range(N_EPOCHS):
+            for _ in ds:
+                pass
+        seconds = time.time() - start
+        print("{:<40} {:>10} {:>12.1f} {:>12.0f} {:>14.1f}".format(data_dir, n, nbytes / 1e6, nbytes / n, n * N_EPOCHS / seconds))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,30 @@
+import gzip
+import hashlib
+import io
+import json
+import os
+import re
+import struct
+import zlib
 import numpy as np
 from utils import *
 
+# records parsed and decoded at once by decode_batch and decode_diff_batch
+DECODE_BATCH = 64
 
-def read_files(files_dir, ds_map, mode="test", all_samples=False):
+
+def shard_files(files_dir, mode="test", all_samples=False, partitions=None, bbox=None):
     if (all_samples) & (mode=='train'):
-       files_train = tf.io.matching_files(files_dir.format("train"))
-       files_valid = tf.io.matching_files(files_dir.format("validation"))
+       files_train = select_shards(files_dir.format("train"), partitions, bbox)
+       files_valid = select_shards(files_dir.format("validation"), partitions, bbox)
        files = tf.concat([files_train,files_valid],0)
     else:
-       files = tf.io.matching_files(files_dir)
+       files = select_shards(files_dir, partitions, bbox)
+    return files
+
+
+def read_files(files_dir, ds_map, mode="test", all_samples=False, partitions=None, bbox=None, batch_size=None, year=None):
+    files = shard_files(files_dir, mode, all_samples, partitions, bbox)
     shards = tf.data.Dataset.from_tensor_slices(files)
     if mode == 'train':
         shards = shards.shuffle(buffer_size=len(files), reshuffle_each_iteration=True)
@@ -16,38 +32,367 @@ def read_files(files_dir, ds_map, mode="test", all_samples=False):
         pass
     else:
         print('pls use a correct data loading mode')
-    dataset = shards.interleave(tf.data.TFRecordDataset)
-    dataset = dataset.map(ds_map, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    compression_type = get_compression_type(files[0].numpy())
+    dataset = shards.interleave(lambda x: tf.data.TFRecordDataset(x, compression_type=compression_type))
+    if bbox is not None:
+        # shards overlapping bbox can still hold records outside of it
+        dataset = dataset.filter(lambda x: in_bbox(x, bbox))
+    if year is not None:
+        # levels records without labels hold one image year each, e.g. to read every image once
+        dataset = dataset.filter(lambda x: in_year(x, year))
+    if batch_size is None:
+        dataset = dataset.map(ds_map, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    else:
+        # ds_map decodes batch_size records at once, e.g. decode_batch; the examples are then passed on one by one
+        dataset = dataset.batch(batch_size).map(ds_map, num_parallel_calls=tf.data.experimental.AUTOTUNE).unbatch()
+    n_records = None if (bbox is not None) | (year is not None) else count_records(files.numpy())
+    if n_records is not None:
+        # interleaved files have an unknown cardinality; this one is checked as the dataset is read
+        dataset = dataset.apply(tf.data.experimental.assert_cardinality(n_records))
     return dataset
 
 
-def decode(serialized_example, feature_description, img_size, n_origin_bands, n_bands, datatype, res, year=''):
-    example = tf.io.parse_single_example(serialized_example, feature_description)
-    image = tf.io.parse_tensor(example[paste_string(['image', year, res])], out_type=float)
+def count_records(files):
+    """Number of records in the shards files, from their shard manifest or else their record indexes.
+
+    Returns None if a shard has neither, e.g. a prep output file that was not sharded.
+    """
+    manifests = {}
+    n_records = 0
+    for path in files:
+        path = path.decode() if isinstance(path, bytes) else path
+        # the manifest of {subset}_..._{region}_{key-}NNNNN-of-NNNNN.tfrecords is {subset}_..._{region}_manifest.json
+        manifest_path = re.sub(r'_[^_/]+\.tfrecords$', '_manifest.json', path)
+        if manifest_path not in manifests:
+            manifests[manifest_path] = {'shards': {}}
+            if os.path.exists(manifest_path):
+                with open(manifest_path) as fh:
+                    manifests[manifest_path] = json.load(fh)
+        shard = manifests[manifest_path]['shards'].get(os.path.basename(path))
+        index_path = path[:-len('.tfrecords')] + '.index.npy'
+        if shard is not None:
+            n_records += shard['n']
+        elif os.path.exists(index_path):
+            # shards written by the prep workers have a record index but no manifest
+            n_records += len(np.load(index_path, mmap_mode='r'))
+        else:
+            return None
+    return n_records
+
+
+def count_labelled(files, label_path, datatype, years, per_image=False):
+    """Number of records in the shards files that is_labelled keeps once their labels are joined from label_path.
+
+    Counted from the record indexes: a record is labelled if the sidecar has finite datatype labels of
+    years (0, 10 or 15) for its img_id. per_image counts the images of levels records, which hold 2000 and
+    2010 of every image, as the pairs of get_diff_dataset read one of them. Returns None if a shard has no
+    record index.
+    """
+    img_ids = []
+    for path in files:
+        path = path.decode() if isinstance(path, bytes) else path
+        index_path = path[:-len('.tfrecords')] + '.index.npy'
+        if not os.path.exists(index_path):
+            return None
+        img_ids.append(np.load(index_path, mmap_mode='r')['img_id'])
+    img_ids = np.concatenate(img_ids)
+    sidecar = np.load(label_path)
+    columns = [[0, 10, 15].index(year) for year in years]
+    keys = ['inc', 'pop'] if datatype == 'inc_pop' else [datatype]
+    finite = np.all([np.isfinite(sidecar[key][:, columns]).all(-1) for key in keys], 0)
+    n_records = int(np.isin(img_ids, sidecar['img_id'][finite]).sum())
+    return n_records // 2 if per_image else n_records
+
+
+def filter_labelled(ds, files, label_path, datatype, years, per_image=False):
+    """Drops the examples without sidecar labels, keeping the cardinality count_labelled gives when files is known."""
+    ds = ds.filter(is_labelled)
+    n_records = None if files is None else count_labelled(files.numpy(), label_path, datatype, years, per_image)
+    if n_records is not None:
+        ds = ds.apply(tf.data.experimental.assert_cardinality(n_records))
+    return ds
+
+
+def select_shards(files_dir, partitions=None, bbox=None):
+    """Shards matching files_dir, only those of partitions and overlapping bbox when either is given.
+
+    partitions are keys of the manifest shard_data.py writes with a partition, e.g. ['s06', 's41'] for
+    partition=state; bbox is (min_lat, min_lng, max_lat, max_lng).
+    """
+    if partitions is None and bbox is None:
+        return tf.io.matching_files(files_dir)
+    manifest_path = files_dir[:-len('*-of-*.tfrecords')] + 'manifest.json'
+    if not os.path.exists(manifest_path):
+        sys.exit('no shard manifest {}, pls run shard_data.py'.format(manifest_path))
+    with open(manifest_path) as fh:
+        manifest = json.load(fh)
+    if partitions is not None and manifest['partition'] == '':
+        sys.exit('the shards of {} are not partitioned'.format(files_dir))
+    files = []
+    for name, shard in sorted(manifest['shards'].items()):
+        if partitions is not None and shard['key'] not in partitions:
+            continue
+        if bbox is not None and (shard['bbox'][0] > bbox[2] or shard['bbox'][2] < bbox[0] or
+                                 shard['bbox'][1] > bbox[3] or shard['bbox'][3] < bbox[1]):
+            continue
+        files.append(os.path.join(os.path.dirname(manifest_path), name))
+    if len(files) == 0:
+        sys.exit('no shards of {} in the given partitions and bbox'.format(files_dir))
+    return tf.constant(files)
+
+
+def in_bbox(serialized_example, bbox):
+    position = tf.io.parse_single_example(serialized_example, {
+        'lat': tf.io.FixedLenFeature((), tf.float32),
+        'lng': tf.io.FixedLenFeature((), tf.float32)
+    })
+    return ((position['lat'] >= bbox[0]) & (position['lat'] <= bbox[2]) &
+            (position['lng'] >= bbox[1]) & (position['lng'] <= bbox[3]))
+
+
+def in_year(serialized_example, year):
+    return tf.io.parse_single_example(serialized_example, {'year': tf.io.FixedLenFeature((), tf.int64)})['year'] == year
+
+
+def load_record_index(files_dir):
+    """Loads the record indexes shard_data.py writes next to the shards matching files_dir, a read_files pattern.
+
+    Returns the shard paths, their compression and one array of img_id, shard number, data offset and
+    data length per record.
+    """
+    files = sorted(tf.io.gfile.glob(files_dir))
+    if len(files) == 0:
+        sys.exit('no shards match {}'.format(files_dir))
+    indexes = []
+    for shard, path in enumerate(files):
+        index_path = path[:-len('.tfrecords')] + '.index.npy'
+        if not os.path.exists(index_path):
+            sys.exit('{} has no record index, pls shard it again'.format(path))
+        index = np.load(index_path)
+        indexes.append(np.rec.fromarrays([index['img_id'], np.full(len(index), shard), index['offset'], index['length']],
+                                         names=['img_id', 'shard', 'offset', 'length']))
+    # the shards of a set are written by one run, with one compression
+    return {'files': files, 'compression_type': get_compression_type(files[0]), 'index': np.concatenate(indexes)}
+
+
+def read_records(record_index, img_ids):
+    """Serialised records of img_ids, read from their byte ranges instead of scanning the shards.
+
+    Every record of an img_id is returned (levels shards hold one per year), grouped by shard.
+    Compressed shards are decompressed up to the records they hold.
+    """
+    index = record_index['index']
+    rows = index[np.isin(index['img_id'], img_ids)]
+    records = []
+    for shard in np.unique(rows['shard']):
+        path = record_index['files'][shard]
+        with open(path, 'rb') as fh:
+            if record_index['compression_type'] == 'GZIP':
+                fh = gzip.GzipFile(fileobj=fh)
+            elif record_index['compression_type'] == 'ZLIB':
+                fh = io.BytesIO(zlib.decompress(fh.read()))
+            for row in np.sort(rows[rows['shard'] == shard], order='offset'):
+                # the 12 byte record header starts with the data length
+                fh.seek(row['offset'] - 12)
+                if struct.unpack('<Q', fh.read(12)[:8])[0] != row['length']:
+                    sys.exit('the record index of {} does not match the shard'.format(path))
+                records.append(fh.read(row['length']))
+    return records
+
+
+def read_ids(files_dir, img_ids, ds_map):
+    """Dataset of the records of img_ids in the shards matching files_dir, mapped with ds_map as read_files does."""
+    records = read_records(load_record_index(files_dir), img_ids)
+    dataset = tf.data.Dataset.from_tensor_slices(tf.constant(records, tf.string))
+    return dataset.map(ds_map, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+
+
+def load_image_store(store_path):
+    """Opens an image store written by process_data/prep_data.py with records=ids.
+
+    The per-year arrays are memory-mapped, so only the images a dataset reads are paged in;
+    'row' maps img_id to the store row through a static hash table.
+    """
+    img_ids = np.load(os.path.join(store_path, 'img_id.npy'))
+    store = {'images': {}}
+    for f in os.listdir(store_path):
+        if re.fullmatch(r'img\d+\.npy', f):
+            store['images'][int(f[3:-4])] = np.load(os.path.join(store_path, f), mmap_mode='r')
+    store['row'] = tf.lookup.StaticHashTable(
+        tf.lookup.KeyValueTensorInitializer(img_ids, np.arange(len(img_ids), dtype=np.int64)), -1)
+    return store
+
+
+def read_store(example, key, store, year=None):
+    # image keys name their year, except the one image of a levels record (image, image_low, image_high),
+    # which is the year of the record; the second image of a diff record (image1, image_low_1) is 2010.
+    # year overrides it, to pair the images of other years at load time
+    band, key_year = re.fullmatch(r'image(?:_(low|high))?_?(\d*)', key).groups()
+    if year is None and key_year == '':
+        year = example['year']
+    elif year is None:
+        year = 10 if key_year == '1' else int(key_year)
+    images = store['images']
+    dtype = next(iter(images.values())).dtype
+    row = store['row'].lookup(example['img_id'])
+    image = tf.numpy_function(lambda row, year: store_rows(images, row, year), [row, year], tf.as_dtype(dtype))
+    image = tf.cast(image, tf.float32)
+    if dtype == np.uint16:
+        image = image / 65535
+    elif dtype == np.uint8:
+        image = image / 255
+    if band == 'low':
+        image = image[..., 0:3]
+    elif band == 'high':
+        image = image[..., 3:6]
+    return image
+
+
+def store_rows(images, row, year):
+    # the image of one record, or the images of a batch of records, each of its own year
+    if np.ndim(row) == 0:
+        return images[int(year)][row]
+    year = np.broadcast_to(year, np.shape(row))
+    return np.stack([images[int(y)][r] for r, y in zip(row, year)])
+
+
+def decode_image(example, key, img_size, n_origin_bands, store=None, year=None):
+    if store is not None:
+        image = read_store(example, key, store, year)
+    else:
+        data = example[key]
+        image = tf.switch_case(tf.cast(example['image_format'], tf.int32), [
+            lambda: tf.io.parse_tensor(data, out_type=float),
+            lambda: tf.cast(tf.io.decode_raw(data, tf.uint16), tf.float32) / 65535,
+            lambda: tf.cast(tf.io.decode_raw(data, tf.uint8), tf.float32) / 255,
+        ])
     image = tf.reshape(image, (img_size, img_size, n_origin_bands))
+    return tf.clip_by_value(image, 0, 1)
+
+
+def parse_tensor_batch(data, n):
+    """tf.io.parse_tensor of a batch of float32 tensors of n values each, as one (batch, n) decode_raw.
+
+    The values are the tensor_content of the serialized TensorProto, which is its last field, so
+    they are the last 4 * n bytes of every string whatever the length of the header before them.
+    """
+    nbytes = tf.fill(tf.shape(data), 4 * n)
+    return tf.io.decode_raw(tf.strings.substr(data, tf.strings.length(data) - nbytes, nbytes), tf.float32)
+
+
+def decode_image_batch(example, key, img_size, n_origin_bands, store=None, year=None):
+    """decode_image of a batch of records parsed with tf.io.parse_example, which share their image format."""
+    if store is not None:
+        image = read_store(example, key, store, year)
+    else:
+        data = example[key]
+        image_format = tf.cast(example['image_format'], tf.int32)
+        tf.debugging.assert_equal(image_format, image_format[0], 'records of different image formats in a batch')
+        image = tf.switch_case(image_format[0], [
+            lambda: parse_tensor_batch(data, img_size * img_size * n_origin_bands),
+            lambda: tf.cast(tf.io.decode_raw(data, tf.uint16), tf.float32) / 65535,
+            lambda: tf.cast(tf.io.decode_raw(data, tf.uint8), tf.float32) / 255,
+        ])
+    image = tf.reshape(image, (-1, img_size, img_size, n_origin_bands))
+    return tf.clip_by_value(image, 0, 1)
+
+
+def load_labels(label_path):
+    """Loads a label sidecar written by process_data/prep_labels.py into constant tensors.
+
+    'row' maps img_id to the sidecar row through a static hash table, -1 for images without a label.
+    """
+    sidecar = np.load(label_path)
+    labels = {k: tf.constant(sidecar[k]) for k in ['inc', 'pop', 'urban_share', 'pop_share', 'baseline_features']}
+    if 'categorical_size' in sidecar:
+        labels['categorical_values'] = tf.constant(sidecar['categorical_values'])
+        labels['categorical_size'] = tf.constant(sidecar['categorical_size'])
+    labels['row'] = tf.lookup.StaticHashTable(
+        tf.lookup.KeyValueTensorInitializer(sidecar['img_id'], np.arange(len(sidecar['img_id']), dtype=np.int64)), -1)
+    return labels
+
+
+def join_labels(example, labels):
+    """Adds the sidecar labels of example['img_id'] under the keys of full records, NaN if it has none."""
+    row = labels['row'].lookup(example['img_id'])
+    found = row >= 0
+    row = tf.maximum(row, 0)
+    for key in ['urban_share', 'pop_share', 'baseline_features']:
+        example[key] = where_found(found, tf.gather(labels[key], row), np.nan)
+    # inc and pop hold 2000, 2010 and 2015; a levels record is tagged with its year, a diff record pairs 2000 and 2010
+    year_index = tf.reduce_sum(tf.cast(example['year'][..., None] >= [10, 15], tf.int32), -1)
+    for key in ['inc', 'pop']:
+        values = where_found(found, tf.gather(labels[key], row), np.nan)
+        example[key] = tf.gather(values, year_index, batch_dims=len(year_index.shape))
+        example[key + '0'] = values[..., 0]
+        example[key + '1'] = values[..., 1]
+        example[key + '10'] = values[..., 1]
+        example[key + '15'] = values[..., 2]
+    if 'categorical_values' in labels:
+        example['categorical_values'] = where_found(found, tf.gather(labels['categorical_values'], row), tf.constant(-1, tf.int64))
+        example['categorical_size'] = labels['categorical_size']
+    return example
+
+
+def where_found(found, values, missing):
+    # found holds one entry per record, values one or more per record
+    found = tf.reshape(found, tf.concat([tf.shape(found), tf.ones([tf.rank(values) - tf.rank(found)], tf.int32)], 0))
+    return tf.where(found, values, missing)
+
+
+def densify_categorical(example):
+    """One-hot county and state vector of a record parsed with get_categorical_description, or joined from the sidecar."""
+    size = tf.cast(example['categorical_size'], tf.int32)
+    return tf.reduce_sum(tf.one_hot(example['categorical_values'], size), 0)
+
+
+def parse_features(example):
+    if example['baseline_features'].dtype == tf.string:
+        features = tf.io.parse_tensor(example['baseline_features'], out_type=float)
+    else:
+        # already joined from the label sidecar
+        features = example['baseline_features']
+    return tf.reshape(features, (34,))
+
+
+def parse_features_batch(example):
+    if example['baseline_features'].dtype == tf.string:
+        features = parse_tensor_batch(example['baseline_features'], 34)
+    else:
+        features = example['baseline_features']
+    return tf.reshape(features, (-1, 34))
+
+
+def is_labelled(*decoded):
+    return tf.reduce_all(tf.math.is_finite(decoded[-1]))
+
+
+def decode(serialized_example, feature_description, img_size, n_origin_bands, n_bands, datatype, res, year='', labels=None,
+           store=None):
+    example = tf.io.parse_single_example(serialized_example, feature_description)
+    if labels is not None:
+        example = join_labels(example, labels)
+    image = decode_image(example, paste_string(['image', year, res]), img_size, n_origin_bands, store)
     image = image[:, :, 0:n_bands]
-    image = tf.clip_by_value(image, 0, 1)
     if datatype == "inc_pop":
         label = tf.reshape(example["inc" + year] - example["pop" + year], [-1])
     else:
         label = tf.reshape(example[datatype + year], [-1])
     label = tf.reshape(example[datatype + year], [-1])
-    features = tf.io.parse_tensor(example['baseline_features'], out_type=float)
-    features = tf.reshape(features, (34,))
+    features = parse_features(example)
 
     return image, features, label
 
 
-def decode_diff(serialized_example, feature_description, img_size, n_origin_bands, n_bands, datatype, res):
+def decode_diff(serialized_example, feature_description, img_size, n_origin_bands, n_bands, datatype, res, labels=None,
+                store=None):
     example = tf.io.parse_single_example(serialized_example, feature_description)
-    image0 = tf.io.parse_tensor(example['image0' if res == '' else paste_string(['image', res, '0'])], out_type=float)
-    image1 = tf.io.parse_tensor(example['image1' if res == '' else paste_string(['image', res, '1'])], out_type=float)
-    image0 = tf.reshape(image0, (img_size, img_size, n_origin_bands))
-    image1 = tf.reshape(image1, (img_size, img_size, n_origin_bands))
+    if labels is not None:
+        example = join_labels(example, labels)
+    image0 = decode_image(example, 'image0' if res == '' else paste_string(['image', res, '0']), img_size, n_origin_bands, store)
+    image1 = decode_image(example, 'image1' if res == '' else paste_string(['image', res, '1']), img_size, n_origin_bands, store)
     image0 = image0[:, :, 0:n_bands]
     image1 = image1[:, :, 0:n_bands]
-    image0 = tf.clip_by_value(image0, 0, 1)
-    image1 = tf.clip_by_value(image1, 0, 1)
     if datatype=="inc_pop":
         label0 = tf.reshape(example['inc0'] - example['pop0'], [-1])
         label1 = tf.reshape(example['inc1'] - example['pop1'], [-1])
@@ -55,35 +400,145 @@ def decode_diff(serialized_example, feature_description, img_size, n_origin_band
         label0 = tf.reshape(example['{}0'.format(datatype)], [-1])
         label1 = tf.reshape(example['{}1'.format(datatype)], [-1])
     label = label1 - label0
-    features = tf.io.parse_tensor(example['baseline_features'], out_type=float)
-    features = tf.reshape(features, (34,))
+    features = parse_features(example)
+
+    return image0, image1, features, label
+
+
+def decode_batch(serialized_examples, feature_description, img_size, n_origin_bands, n_bands, datatype, res, year='',
+                 labels=None, store=None):
+    """decode of a batch of records, parsed with one tf.io.parse_example and decoded with vectorised ops."""
+    example = tf.io.parse_example(serialized_examples, feature_description)
+    if labels is not None:
+        example = join_labels(example, labels)
+    image = decode_image_batch(example, paste_string(['image', year, res]), img_size, n_origin_bands, store)
+    image = image[..., 0:n_bands]
+    label = tf.reshape(example[datatype + year], [-1, 1])
+    features = parse_features_batch(example)
+
+    return image, features, label
+
+
+def decode_diff_batch(serialized_examples, feature_description, img_size, n_origin_bands, n_bands, datatype, res,
+                      labels=None, store=None):
+    """decode_diff of a batch of records, parsed with one tf.io.parse_example and decoded with vectorised ops."""
+    example = tf.io.parse_example(serialized_examples, feature_description)
+    if labels is not None:
+        example = join_labels(example, labels)
+    image0 = decode_image_batch(example, 'image0' if res == '' else paste_string(['image', res, '0']), img_size, n_origin_bands, store)
+    image1 = decode_image_batch(example, 'image1' if res == '' else paste_string(['image', res, '1']), img_size, n_origin_bands, store)
+    image0 = image0[..., 0:n_bands]
+    image1 = image1[..., 0:n_bands]
+    if datatype=="inc_pop":
+        label0 = tf.reshape(example['inc0'] - example['pop0'], [-1, 1])
+        label1 = tf.reshape(example['inc1'] - example['pop1'], [-1, 1])
+    else:
+        label0 = tf.reshape(example['{}0'.format(datatype)], [-1, 1])
+        label1 = tf.reshape(example['{}1'.format(datatype)], [-1, 1])
+    label = label1 - label0
+    features = parse_features_batch(example)
+
+    return image0, image1, features, label
+
+
+def pair_label(example, datatype, pair):
+    # the sidecar labels of the two years of pair, e.g. inc10 and inc15, differenced as in decode_diff
+    year0, year1 = [str(year) for year in pair]
+    if datatype == "inc_pop":
+        label0 = example['inc' + year0] - example['pop' + year0]
+        label1 = example['inc' + year1] - example['pop' + year1]
+    else:
+        label0 = example[datatype + year0]
+        label1 = example[datatype + year1]
+    return label1 - label0
+
+
+def decode_pair(serialized_example, feature_description, img_size, n_origin_bands, n_bands, datatype, res, pair, labels,
+                store):
+    """decode_diff of the image pair (year0, year1) of a levels record, joined from the image store and label sidecar."""
+    example = tf.io.parse_single_example(serialized_example, feature_description)
+    example = join_labels(example, labels)
+    image0 = decode_image(example, paste_string(['image', res]), img_size, n_origin_bands, store, pair[0])
+    image1 = decode_image(example, paste_string(['image', res]), img_size, n_origin_bands, store, pair[1])
+    image0 = image0[:, :, 0:n_bands]
+    image1 = image1[:, :, 0:n_bands]
+    label = tf.reshape(pair_label(example, datatype, pair), [-1])
+    features = parse_features(example)
 
     return image0, image1, features, label
 
 
-def data_process_train(image, features, label, img_size, img_augmented_size, n_bands, with_feature):
-    fraction = np.random.uniform(0.90, 1.0, 1)
-    image = tf.image.random_flip_left_right(image)
-    image = tf.image.central_crop(image, fraction)
-    image = tf.image.resize(image, [img_size, img_size])
-    image = tf.image.resize_with_crop_or_pad(image, img_augmented_size, img_augmented_size)
-    image = tf.image.random_crop(image, size=[tf.shape(image)[0], img_size, img_size, n_bands])
+def decode_pair_batch(serialized_examples, feature_description, img_size, n_origin_bands, n_bands, datatype, res, pair,
+                      labels, store):
+    """decode_pair of a batch of records, parsed with one tf.io.parse_example and decoded with vectorised ops."""
+    example = tf.io.parse_example(serialized_examples, feature_description)
+    example = join_labels(example, labels)
+    image0 = decode_image_batch(example, paste_string(['image', res]), img_size, n_origin_bands, store, pair[0])
+    image1 = decode_image_batch(example, paste_string(['image', res]), img_size, n_origin_bands, store, pair[1])
+    image0 = image0[..., 0:n_bands]
+    image1 = image1[..., 0:n_bands]
+    label = tf.reshape(pair_label(example, datatype, pair), [-1, 1])
+    features = parse_features_batch(example)
+
+    return image0, image1, features, label
+
+
+def augment_seeds(seed=None):
+    """Dataset of stateless random seeds, one per batch, which differ from epoch to epoch but are fixed by seed.
+
+    The seeds are drawn from a tf.random.Generator, whose state carries on from one epoch to the next.
+    Without seed, the generator is seeded from the global TensorFlow seed.
+    """
+    if seed is None:
+        seed = tf.random.uniform([], maxval=2 ** 31 - 1, dtype=tf.int64)
+    generator = tf.random.Generator.from_seed(seed)
+    return tf.data.experimental.Counter().map(lambda _: generator.make_seeds(1)[:, 0])
+
+
+def augment(image, seed, img_size, img_augmented_size):
+    """Randomly augments each image of a batch: flip, central crop, resize, zero pad and crop back to img_size.
+
+    Every image gets its own draws, as tf.image.random_flip_left_right, central_crop of 90 to 100% of
+    its side, resize, resize_with_crop_or_pad to img_augmented_size and an img_size random_crop would
+    give it alone. The draws are stateless functions of seed, so a batch gets the same ones whenever
+    it is given the same seed.
+    """
+    n = tf.shape(image)[0]
+    seeds = tf.random.experimental.stateless_split(seed, 3)
+    fraction = tf.random.stateless_uniform([n], seeds[0], 0.90, 1.0)
+    offset = tf.random.stateless_uniform([n, 2], seeds[1], 0, img_augmented_size - img_size + 1, dtype=tf.int32)
+    flip = tf.random.stateless_uniform([n], seeds[2]) < 0.5
+    # central_crop removes whole pixels, so there are only a few crops: resize the images of each one together
+    border = tf.cast((img_size - img_size * fraction) / 2, tf.int32)
+    parts, indices = [], []
+    for k in range(int(img_size * 0.10 / 2) + 1):
+        index = tf.cast(tf.where(border == k)[:, 0], tf.int32)
+        parts.append(tf.image.resize(tf.gather(image, index)[:, k:img_size - k, k:img_size - k], [img_size, img_size]))
+        indices.append(index)
+    image = tf.dynamic_stitch(indices, parts)
+    # pad once, with a spare zero column on either side for flipped crops, and crop every image by its own
+    # rows and columns; flipping before the crop reverses the columns taken
+    pad = (img_augmented_size - img_size) // 2
+    extra = img_augmented_size - img_size - pad
+    image = tf.pad(image, [[0, 0], [pad, extra], [pad + 1, extra + 1], [0, 0]])
+    pixels = tf.range(img_size)[None]
+    rows = offset[:, :1] + pixels
+    cols = tf.where(flip[:, None], img_size + 2 * pad - (offset[:, 1:] + pixels), offset[:, 1:] + pixels + 1)
+    image = tf.gather(image, rows, axis=1, batch_dims=1)
+    return tf.gather(image, cols, axis=2, batch_dims=1)
+
+
+def data_process_train(image, features, label, img_size, img_augmented_size, with_feature, seed):
+    image = augment(image, seed, img_size, img_augmented_size)
     if with_feature:
         return (image, features), label
     else:
         return image, label
 
 
-def data_process_diff_train(image0, image1, features, label, img_size, img_augmented_size, n_bands, with_feature):
-    fraction = np.random.uniform(0.90, 1.0, 1)
-    image0 = tf.image.central_crop(image0, fraction)
-    image0 = tf.image.resize(image0, [img_size, img_size])
-    image0 = tf.image.resize_with_crop_or_pad(image0, img_augmented_size, img_augmented_size)
-    image0 = tf.image.random_crop(image0, size=[tf.shape(image0)[0], img_size, img_size, n_bands])
-    image1 = tf.image.central_crop(image1, fraction)
-    image1 = tf.image.resize(image1, [img_size, img_size])
-    image1 = tf.image.resize_with_crop_or_pad(image1, img_augmented_size, img_augmented_size)
-    image1 = tf.image.random_crop(image1, size=[tf.shape(image1)[0], img_size, img_size, n_bands])
+def data_process_diff_train(image0, image1, features, label, img_size, img_augmented_size, with_feature, seed):
+    # both images of a pair get the same augmentation, applied to their bands side by side
+    image0, image1 = tf.split(augment(tf.concat([image0, image1], -1), seed, img_size, img_augmented_size), 2, -1)
     if with_feature:
         return (image0, image1, features), label
     else:
@@ -104,31 +559,118 @@ def data_process_diff(image0, image1, features, label, with_feature):
         return (image0, image1), label
 
 
-def get_dataset(ds_dir, size, datatype, model_type, with_feature, bs, year, region, resolution, subset, all_samples=False):
+def cache_key(ds_dir, size, datatype, model_type, year, region, resolution, subset, all_samples=False, label_path=None,
+              store_path=None, partitions=None, bbox=None, pair=None):
+    """Name of the decoded examples of a configuration in a cache directory, e.g. small_national_low_base_merged_inc_train_1a2b3c4d.
+
+    The hash covers the shards, label sidecar, image store and selection the examples were read with.
+    """
+    if all_samples and subset == 'train':
+        subset = 'train_all'
+    if pair is not None:
+        year = '{}_{}'.format(*pair)
+    digest = hashlib.md5(repr((ds_dir, label_path, store_path, partitions, bbox)).encode()).hexdigest()[:8]
+    return '_'.join([size, region, resolution, model_type, str(year), datatype, subset, digest])
+
+
+def cache_decoded(ds, cache, key):
+    """Caches decoded examples ahead of the shuffle and augmentation, so that only the first epoch parses and decodes.
+
+    cache is None for no cache, 'memory' to keep the examples in memory once the first epoch has read
+    them, or a local scratch directory to snapshot them in cache/key. A snapshot is written by the first
+    epoch of a run and read by every later one, including later runs with the same configuration.
+    """
+    if cache is None:
+        return ds
+    if cache == 'memory':
+        return ds.cache()
+    return ds.snapshot(os.path.join(cache, key), compression=None)
+
+
+def get_dataset(ds_dir, size, datatype, model_type, with_feature, bs, year, region, resolution, subset, all_samples=False,
+                label_path=None, store_path=None, partitions=None, bbox=None, cache=None, batch_decode=True,
+                augment_seed=None):
+    key = cache_key(ds_dir, size, datatype, model_type, year, region, resolution, subset, all_samples, label_path,
+                    store_path, partitions, bbox)
     img_size, img_augmented_size, n_origin_bands, n_bands, res = get_img_size(size, model_type, region, resolution)
     test_type, feature_type, year = get_type(year, region)
-    feature_description = get_feature_description(feature_type)
-    decode_map = lambda x: decode(x, feature_description, img_size, n_origin_bands, n_bands, datatype, res, year)
-    ds = read_files(ds_dir.format(test_type, subset, test_type), decode_map, subset, all_samples)
+    feature_description = get_record_feature_description(feature_type, label_path, store_path)
+    labels = None if label_path is None else load_labels(label_path)
+    store = None if store_path is None else load_image_store(store_path)
+    if batch_decode:
+        decode_map = lambda x: decode_batch(x, feature_description, img_size, n_origin_bands, n_bands, datatype, res, year, labels, store)
+        batch_size = DECODE_BATCH
+    else:
+        # the per-record path the loaders used before decode_batch
+        decode_map = lambda x: decode(x, feature_description, img_size, n_origin_bands, n_bands, datatype, res, year, labels, store)
+        batch_size = None
+    ds = read_files(ds_dir.format(test_type, subset, test_type), decode_map, subset, all_samples, partitions, bbox, batch_size)
+    if labels is not None:
+        # records filtered by bbox are not counted; the levels records are of 2000 and 2010
+        files = None if bbox is not None else shard_files(ds_dir.format(test_type, subset, test_type), subset, all_samples, partitions)
+        ds = filter_labelled(ds, files, label_path, datatype, [0, 10] if year == '' else [int(year)])
+    ds = cache_decoded(ds, cache, key)
     if subset == "train":
-        process_map = lambda x, y, z: data_process_train(x, y, z, img_size, img_augmented_size, n_bands, with_feature)
+        process_map = lambda batch, seed: data_process_train(*batch, img_size, img_augmented_size, with_feature, seed)
         ds = ds.shuffle(10000)
+        ds = tf.data.Dataset.zip((ds.batch(bs), augment_seeds(augment_seed)))
     elif (subset == "validation") | (subset == "test"):
         process_map = lambda x, y, z: data_process(x, y, z, with_feature)
-    ds = ds.batch(bs).map(process_map, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        ds = ds.batch(bs)
+    ds = ds.map(process_map, num_parallel_calls=tf.data.experimental.AUTOTUNE)
     return ds
 
 
-def get_diff_dataset(ds_dir, size, datatype, model_type, with_feature, bs, year, region, resolution, subset, all_samples=False):
+def get_diff_dataset(ds_dir, size, datatype, model_type, with_feature, bs, year, region, resolution, subset, all_samples=False,
+                     label_path=None, store_path=None, partitions=None, bbox=None, cache=None, batch_decode=True,
+                     augment_seed=None, pair=None):
+    """Dataset of the diff records of subset, or with pair, e.g. (2010, 2015), of image pairs built at load time.
+
+    pair reads the images of both years from the image store, for the levels records of 2000 (one per img_id),
+    and differences their labels from the label sidecar, so no diff records are needed for it.
+    """
+    key = cache_key(ds_dir, size, datatype, model_type, year, region, resolution, subset, all_samples, label_path,
+                    store_path, partitions, bbox, pair)
     img_size, img_augmented_size, n_origin_bands, n_bands, res = get_img_size(size, model_type, region, resolution)
+    if pair is not None:
+        if (label_path is None) | (store_path is None):
+            sys.exit('pls give the label sidecar and image store to pair years at load time')
+        # the years of the sidecar labels and the image store arrays, e.g. 10 for 2010
+        pair = [int(year) - 2000 for year in pair]
+        if any(year not in [0, 10, 15] for year in pair):
+            sys.exit('pls pair 2000, 2010 or 2015, the years with labels')
+        year = 'merged'
     test_type, feature_type, year = get_type(year, region)
-    feature_description = get_feature_description(feature_type)
-    decode_map = lambda x: decode_diff(x, feature_description, img_size, n_origin_bands, n_bands, datatype, res)
-    ds = read_files(ds_dir.format(test_type, subset, test_type), decode_map, subset, all_samples)
+    feature_description = get_record_feature_description(feature_type, label_path, store_path)
+    labels = None if label_path is None else load_labels(label_path)
+    store = None if store_path is None else load_image_store(store_path)
+    if pair is not None:
+        if any(year not in store['images'] for year in pair):
+            sys.exit('the image store of {} has no images of {}'.format(store_path, pair))
+        if batch_decode:
+            decode_map = lambda x: decode_pair_batch(x, feature_description, img_size, n_origin_bands, n_bands, datatype, res, pair, labels, store)
+        else:
+            decode_map = lambda x: decode_pair(x, feature_description, img_size, n_origin_bands, n_bands, datatype, res, pair, labels, store)
+    elif batch_decode:
+        decode_map = lambda x: decode_diff_batch(x, feature_description, img_size, n_origin_bands, n_bands, datatype, res, labels, store)
+    else:
+        # the per-record path the loaders used before decode_batch
+        decode_map = lambda x: decode_diff(x, feature_description, img_size, n_origin_bands, n_bands, datatype, res, labels, store)
+    batch_size = DECODE_BATCH if batch_decode else None
+    # the levels records hold every image once for 2000
+    record_year = None if pair is None else 0
+    ds = read_files(ds_dir.format(test_type, subset, test_type), decode_map, subset, all_samples, partitions, bbox, batch_size,
+                    record_year)
+    if labels is not None:
+        files = None if bbox is not None else shard_files(ds_dir.format(test_type, subset, test_type), subset, all_samples, partitions)
+        ds = filter_labelled(ds, files, label_path, datatype, [0, 10] if pair is None else pair, pair is not None)
+    ds = cache_decoded(ds, cache, key)
     if subset == "train":
-        process_map = lambda a, b, c, d: data_process_diff_train(a, b, c, d, img_size, img_augmented_size, n_bands, with_feature)
+        process_map = lambda batch, seed: data_process_diff_train(*batch, img_size, img_augmented_size, with_feature, seed)
         ds = ds.shuffle(10000, reshuffle_each_iteration=True)
+        ds = tf.data.Dataset.zip((ds.batch(bs), augment_seeds(augment_seed)))
     elif (subset == "validation") | (subset == "test"):
         process_map = lambda a, b, c, d: data_process_diff(a, b, c, d, with_feature)
-    ds = ds.batch(bs).map(process_map, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        ds = ds.batch(bs)
+    ds = ds.map(process_map, num_parallel_calls=tf.data.experimental.AUTOTUNE)
     return ds
@@ -28,6 +28,8 @@ ds = int(sys.argv[15])
 nf = int(sys.argv[16])
 dr = float(sys.argv[17])
 all_sample = get_bool(sys.argv[18]) # [True, False]
+label_path = sys.argv[19] if len(sys.argv) > 19 and sys.argv[19] != 'None' else None  # label sidecar of shards prepped with records=images
+store_path = sys.argv[20] if len(sys.argv) > 20 and sys.argv[20] != 'None' else None  # image store of shards prepped with records=ids
 
 if datatype == "inc":
     years = [[0,10], [0,15], [10,15]]
@@ -46,12 +48,12 @@ ds_dir = '{}/{}_{}_{}_{}/{}_{}_{}_{}_{}_*-of-*.tfrecords'\
 def main():
     df = pd.DataFrame()
     img_size, img_augmented_size, n_origin_bands, n_bands, res = get_img_size(size, model_type, region, resolution)
-    feature_description = get_feature_description(feature_type='test')
-    if region == "mw":
-        feature_description = get_feature_description(feature_type='mw_15')
-    train = read_files(ds_dir.format(15, 'train', 15), lambda x: parse(x, feature_description, img_size, n_origin_bands, n_bands, res))
-    valid = read_files(ds_dir.format(15, 'validation', 15), lambda x: parse(x, feature_description, img_size, n_origin_bands, n_bands, res))
-    test = read_files(ds_dir.format(15, 'test', 15), lambda x: parse(x, feature_description, img_size, n_origin_bands, n_bands, res))
+    feature_description = get_record_feature_description('mw_15' if region == "mw" else 'test', label_path, store_path)
+    labels = None if label_path is None else load_labels(label_path)
+    store = None if store_path is None else load_image_store(store_path)
+    train = read_files(ds_dir.format(15, 'train', 15), lambda x: parse(x, feature_description, img_size, n_origin_bands, n_bands, res, labels, store), batch_size=DECODE_BATCH)
+    valid = read_files(ds_dir.format(15, 'validation', 15), lambda x: parse(x, feature_description, img_size, n_origin_bands, n_bands, res, labels, store), batch_size=DECODE_BATCH)
+    test = read_files(ds_dir.format(15, 'test', 15), lambda x: parse(x, feature_description, img_size, n_origin_bands, n_bands, res, labels, store), batch_size=DECODE_BATCH)
     model = make_level_model(img_size, n_bands, l2, nf, dr, with_feature)
     diff_model = make_diff_model(img_size, n_bands, l2, nf, dr, with_feature, model)
     diff_model.compile(optimizer=tf.keras.optimizers.Adam(lr), loss="mean_squared_error", metrics=[RSquare()])
@@ -78,15 +80,16 @@ def predict(ds, model, df):
         df = df.append(row, ignore_index=True)
     return df
 
-def parse(serialized_example, feature_description, img_size, n_origin_bands, n_bands, res):
+def parse(serialized_examples, feature_description, img_size, n_origin_bands, n_bands, res, labels=None, store=None):
     if (res == '_high') | (res == '_low'):
         res = res + '_'
-    example = tf.io.parse_single_example(serialized_example, feature_description)
-    image0 = tf.stack([tf.clip_by_value(tf.reshape(tf.io.parse_tensor(example['image{}{}'.format(res, y[0])], out_type=float),(img_size, img_size, n_origin_bands))[:, :, 0:n_bands], 0, 1) for y in years], 0)
-    image1 = tf.stack([tf.clip_by_value(tf.reshape(tf.io.parse_tensor(example['image{}{}'.format(res, y[1])], out_type=float),(img_size, img_size, n_origin_bands))[:, :, 0:n_bands], 0, 1) for y in years], 0)
-    features = tf.io.parse_tensor(example['baseline_features'], out_type=float)
-    features = tf.reshape(features, (34,))
-    features = tf.stack([features for y in years], 0)
+    example = tf.io.parse_example(serialized_examples, feature_description)
+    if labels is not None:
+        example = join_labels(example, labels)
+    image0 = tf.stack([decode_image_batch(example, 'image{}{}'.format(res, y[0]), img_size, n_origin_bands, store)[..., 0:n_bands] for y in years], 1)
+    image1 = tf.stack([decode_image_batch(example, 'image{}{}'.format(res, y[1]), img_size, n_origin_bands, store)[..., 0:n_bands] for y in years], 1)
+    features = parse_features_batch(example)
+    features = tf.stack([features for y in years], 1)
     img_id = example['img_id']
 
     return image0, image1, features, img_id
@@ -30,6 +30,8 @@ ds = int(sys.argv[15])
 nf = int(sys.argv[16])
 dr = float(sys.argv[17])
 all_sample = get_bool(sys.argv[18]) # [True, False]
+label_path = sys.argv[19] if len(sys.argv) > 19 and sys.argv[19] != 'None' else None  # records=imagesで作成したシャードのラベルファイル
+store_path = sys.argv[20] if len(sys.argv) > 20 and sys.argv[20] != 'None' else None  # records=idsで作成したシャードの画像ストア
 
 # 入力データに含まれる年度（予測する年）
 if datatype == "inc":
@@ -49,14 +51,14 @@ ds_dir = '{}/{}_{}_{}_{}/{}_{}_{}_{}_{}_*-of-*.tfrecords'\
 def main():
     df = pd.DataFrame()
     img_size, _, n_origin_bands, n_bands, res = get_img_size(size, model_type, region, resolution)
-    if region == "mw":
-        feature_description = get_feature_description(feature_type='mw_15')
-    else:
-        feature_description = get_feature_description(feature_type='test')
+    # 画像のみのレコードではラベルと特徴量をラベルファイルから、IDのみのレコードでは画像も画像ストアから結合
+    feature_description = get_record_feature_description('mw_15' if region == "mw" else 'test', label_path, store_path)
+    labels = None if label_path is None else load_labels(label_path)
+    store = None if store_path is None else load_image_store(store_path)
     # TFRecordデータ読み込み（train, validation, test）
-    train = read_files(ds_dir.format(15, 'train', 15), lambda x: parse(x, feature_description, img_size, n_origin_bands, n_bands, res))
-    valid = read_files(ds_dir.format(15, 'validation', 15), lambda x: parse(x, feature_description, img_size, n_origin_bands, n_bands, res))
-    test = read_files(ds_dir.format(15, 'test', 15), lambda x: parse(x, feature_description, img_size, n_origin_bands, n_bands, res))
+    train = read_files(ds_dir.format(15, 'train', 15), lambda x: parse(x, feature_description, img_size, n_origin_bands, n_bands, res, labels, store), batch_size=DECODE_BATCH)
+    valid = read_files(ds_dir.format(15, 'validation', 15), lambda x: parse(x, feature_description, img_size, n_origin_bands, n_bands, res, labels, store), batch_size=DECODE_BATCH)
+    test = read_files(ds_dir.format(15, 'test', 15), lambda x: parse(x, feature_description, img_size, n_origin_bands, n_bands, res, labels, store), batch_size=DECODE_BATCH)
     
     # モデルの構築・重みの読み込み
     model = make_level_model(img_size, n_bands, l2, nf, dr, with_feature)
@@ -90,15 +92,16 @@ def predict(ds, model, df):
         df = df.append(row, ignore_index=True)
     return df
 
-def parse(serialized_example, feature_description, img_size, n_origin_bands, n_bands, res):
-    example = tf.io.parse_single_example(serialized_example, feature_description)
+def parse(serialized_examples, feature_description, img_size, n_origin_bands, n_bands, res, labels=None, store=None):
+    example = tf.io.parse_example(serialized_examples, feature_description)
+    if labels is not None:
+        example = join_labels(example, labels)
      # 複数年の画像をスタック（例：2000, 2010, 2015）
-    image = tf.stack([tf.clip_by_value(tf.reshape(tf.io.parse_tensor(example['image'+y if res == '' else paste_string(['image', res, y])], out_type=float),(img_size, img_size, n_origin_bands))[:, :, 0:n_bands], 0, 1) for y in years], 0)
+    image = tf.stack([decode_image_batch(example, 'image'+y if res == '' else paste_string(['image', res, y]), img_size, n_origin_bands, store)[..., 0:n_bands] for y in years], 1)
     
     # 追加の統計特徴量（34次元ベクトル）を年数分複製
-    features = tf.io.parse_tensor(example['baseline_features'], out_type=float)
-    features = tf.reshape(features, (34,))
-    features = tf.stack([features for y in years], 0)
+    features = parse_features_batch(example)
+    features = tf.stack([features for y in years], 1)
     img_id = example['img_id']
 
     return image, features, img_id
@@ -23,6 +23,8 @@
 # Note: When all_images == False, model will be trained on training set and validated on validation set for hyperparameter tuning then test on test set
 # when all_images == True, model will be trained on training set + validation set and validated on test set, so the results of validation set and 
 # test set in tensorboard will be the same.
+# cache (optional, after the label sidecar and image store paths, which may be None): memory, or a local scratch directory
+# where the decoded examples are snapshotted once and reused by later epochs, trials and runs.
 
 DATA=${CNN_PROJECT_ROOT}/data
 OUTPUTS=${CNN_PROJECT_ROOT}/weights
@@ -85,6 +87,8 @@ python train_level_model.py block national base large inc low True 200 $DATA $OU
     # level_nf
     # level_dr
     # level_epochs
+# pair (optional, after the label sidecar, image store and cache, which may be None): two of 2000, 2010 and 2015, e.g. 2010,2015,
+# to build the image pairs from the levels records and image store of a records=ids prep run instead of reading the diff records.
 python train_diff_model.py block national base large inc low True 100 $DATA $OUTPUTS weights 1e-4 1e-8 16 200 32 0.5 200 False
 # python train_diff_model.py block national base large pop low True 100 $DATA $OUTPUTS weights 1e-4 1e-7 16 50 32 0.5 200 False
 # python train_diff_model.py block national base small inc low True 100 $DATA $OUTPUTS weights 1e-4 1e-8 16 200 32 0.5 200 False
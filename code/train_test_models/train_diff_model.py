@@ -31,6 +31,11 @@ level_nf = int(sys.argv[16])
 level_dr = float(sys.argv[17])
 level_epochs = int(sys.argv[18])
 all_sample = get_bool(sys.argv[19])
+label_path = sys.argv[20] if len(sys.argv) > 20 and sys.argv[20] != 'None' else None  # label sidecar of shards prepped with records=images
+store_path = sys.argv[21] if len(sys.argv) > 21 and sys.argv[21] != 'None' else None  # image store of shards prepped with records=ids
+cache = sys.argv[22] if len(sys.argv) > 22 and sys.argv[22] != 'None' else None  # 'memory' or a local scratch directory to cache decoded examples in
+# year pair built at load time from the levels records, image store and label sidecar, e.g. 2010,2015; the diff records by default
+pair = tuple(int(x) for x in sys.argv[23].split(',')) if len(sys.argv) > 23 else None
 
 HP_LR = hp.HParam('lr', hp.Discrete([1e-4, 1e-5]))
 HP_L2 = hp.HParam('l2', hp.Discrete([1e-6, 1e-7, 1e-8]))
@@ -45,9 +50,10 @@ weight_dir = '{}/{}_{}_{}_level_{}{}{}_{}_{}{}/checkpoints/{}_{}_{}_{}_{}_{}' \
     .format(weight_dir, construct, size, region, model_type, '_feature' if with_feature else '',
             '_high' if resolution == 'high' else '', datatype, level_epochs,'_all' if all_sample else '', level_lr, level_l2,
             level_bs, level_ds, level_nf, level_dr)
-out_dir = '{}/{}_{}_{}_diff_{}{}{}_{}_{}' \
-    .format(out_dir, construct, size, region, model_type, '_feature' if with_feature else '',
-            '_high' if resolution == 'high' else '', datatype, epochs, '_all' if all_sample else '')
+out_dir = '{}/{}_{}_{}_diff{}_{}{}{}_{}_{}' \
+    .format(out_dir, construct, size, region, '' if pair is None else '_{}_{}'.format(*pair), model_type,
+            '_feature' if with_feature else '', '_high' if resolution == 'high' else '', datatype, epochs,
+            '_all' if all_sample else '')
 logdir = '{}/logs'.format(out_dir)
 checkdir = '{}/checkpoints'.format(out_dir)
 
@@ -71,9 +77,9 @@ def main():
     year = 'diff'
     bs = 16
     img_size, _, _, n_bands, _ = get_img_size(size, model_type, region, resolution)
-    train = get_diff_dataset(ds_dir, size, datatype, model_type, with_feature, bs, year, region, resolution, 'train', all_sample)
-    valid = get_diff_dataset(ds_dir, size, datatype, model_type, with_feature, bs, year, region, resolution, 'test' if all_sample else 'validation', all_sample)
-    test = get_diff_dataset(ds_dir, size, datatype, model_type, with_feature, bs, year, region, resolution, 'test')
+    train = get_diff_dataset(ds_dir, size, datatype, model_type, with_feature, bs, year, region, resolution, 'train', all_sample, label_path, store_path, cache=cache, pair=pair)
+    valid = get_diff_dataset(ds_dir, size, datatype, model_type, with_feature, bs, year, region, resolution, 'test' if all_sample else 'validation', all_sample, label_path, store_path, cache=cache, pair=pair)
+    test = get_diff_dataset(ds_dir, size, datatype, model_type, with_feature, bs, year, region, resolution, 'test', label_path=label_path, store_path=store_path, cache=cache, pair=pair)
     model = make_level_model(img_size, n_bands, level_l2, level_nf, level_dr, with_feature)
     model.load_weights(weight_dir).expect_partial()
     with tf.summary.create_file_writer(logdir + '/hparam_tuning/').as_default():
@@ -21,6 +21,9 @@ epochs = int(sys.argv[8])  # how many epochs to train for?
 data_dir = sys.argv[9]  # /source/data or ../temp
 out_dir = sys.argv[10]  # /storage/national_level_result large or small
 all_sample = get_bool(sys.argv[11]) # [True, False]
+label_path = sys.argv[12] if len(sys.argv) > 12 and sys.argv[12] != 'None' else None  # label sidecar of shards prepped with records=images
+store_path = sys.argv[13] if len(sys.argv) > 13 and sys.argv[13] != 'None' else None  # image store of shards prepped with records=ids
+cache = sys.argv[14] if len(sys.argv) > 14 and sys.argv[14] != 'None' else None  # 'memory' or a local scratch directory to cache decoded examples in
 
 HP_LR = hp.HParam('lr', hp.Discrete([1e-4]))
 HP_L2 = hp.HParam('l2', hp.Discrete([1e-6, 1e-7, 1e-8]))
@@ -58,9 +61,9 @@ def main():
     bs = 16
     img_size, _, _, n_bands, _ = get_img_size(size, model_type, region, resolution)
 
-    train = get_dataset(ds_dir, size, datatype, model_type, with_feature, bs, year, region, resolution, 'train', all_sample)
-    valid = get_dataset(ds_dir, size, datatype, model_type, with_feature, bs, year, region, resolution, 'test' if all_sample else 'validation', all_sample)
-    test = get_dataset(ds_dir, size, datatype, model_type, with_feature, bs, year, region, resolution, 'test', all_sample)
+    train = get_dataset(ds_dir, size, datatype, model_type, with_feature, bs, year, region, resolution, 'train', all_sample, label_path, store_path, cache=cache)
+    valid = get_dataset(ds_dir, size, datatype, model_type, with_feature, bs, year, region, resolution, 'test' if all_sample else 'validation', all_sample, label_path, store_path, cache=cache)
+    test = get_dataset(ds_dir, size, datatype, model_type, with_feature, bs, year, region, resolution, 'test', all_sample, label_path, store_path, cache=cache)
 
     with tf.summary.create_file_writer(logdir + '/hparam_tuning/').as_default():
         hp.hparams_config(
@@ -13,8 +13,7 @@ def get_feature_description(feature_type):
             'lng': tf.io.FixedLenFeature((), tf.float32),
             'urban_share': tf.io.FixedLenFeature((), tf.float32),
             'pop_share': tf.io.FixedLenFeature((), tf.float32),
-            'baseline_features': tf.io.FixedLenFeature((), tf.string),
-            'categorical_values': tf.io.FixedLenFeature((), tf.string)
+            'baseline_features': tf.io.FixedLenFeature((), tf.string)
         }
     elif feature_type == "diff":
         feature_description = {
@@ -29,8 +28,7 @@ def get_feature_description(feature_type):
             'lng': tf.io.FixedLenFeature((), tf.float32),
             'urban_share': tf.io.FixedLenFeature((), tf.float32),
             'pop_share': tf.io.FixedLenFeature((), tf.float32),
-            'baseline_features': tf.io.FixedLenFeature((), tf.string),
-            'categorical_values': tf.io.FixedLenFeature((), tf.string)
+            'baseline_features': tf.io.FixedLenFeature((), tf.string)
         }
     elif feature_type == 'mw_level':
         feature_description = {
@@ -103,11 +101,46 @@ def get_feature_description(feature_type):
             'lng': tf.io.FixedLenFeature((), tf.float32),
             'urban_share': tf.io.FixedLenFeature((), tf.float32),
             'pop_share': tf.io.FixedLenFeature((), tf.float32),
-            'baseline_features': tf.io.FixedLenFeature((), tf.string),
-            'categorical_values': tf.io.FixedLenFeature((), tf.string)
+            'baseline_features': tf.io.FixedLenFeature((), tf.string)
         }
     else:
         sys.exit('pls use a correct model_type')
+    # records written before the compact image formats carry no image_format and hold float32 tensors
+    feature_description['image_format'] = tf.io.FixedLenFeature((), tf.int64, default_value=0)
+    return feature_description
+
+
+def get_categorical_description():
+    """Feature description of the county and state of national records, which no model reads by default.
+
+    categorical_values holds the positions of the county and state ones in a one-hot vector of
+    categorical_size entries; data_loader.densify_categorical rebuilds that vector.
+    """
+    return {
+        'categorical_values': tf.io.FixedLenFeature((2,), tf.int64),
+        'categorical_size': tf.io.FixedLenFeature((), tf.int64)
+    }
+
+
+def get_image_feature_description(feature_type):
+    """Feature description of records prepped with records=images, which leave the labels to the label sidecar."""
+    feature_description = {k: v for k, v in get_feature_description(feature_type).items() if k.startswith('image')}
+    feature_description['img_id'] = tf.io.FixedLenFeature((), tf.int64)
+    # levels records hold one year each, the labels of which are picked from the sidecar
+    feature_description['year'] = tf.io.FixedLenFeature((), tf.int64, default_value=0)
+    return feature_description
+
+
+def get_record_feature_description(feature_type, label_path=None, store_path=None):
+    """Feature description of the records a loader reads, by where their labels and images are kept."""
+    if label_path is None:
+        if store_path is not None:
+            sys.exit('the image store needs the label sidecar')
+        return get_feature_description(feature_type)
+    feature_description = get_image_feature_description(feature_type)
+    if store_path is not None:
+        # records prepped with records=ids only refer to their images in the image store
+        feature_description = {k: v for k, v in feature_description.items() if not k.startswith('image')}
     return feature_description
 
 
@@ -196,7 +229,26 @@ def get_type(year, region):
     return test_type, feature_type, year
 
 
+# a copy of get_compression_type in process_data/prep_utils.py, which the loaders do not import: the script directories
+# do not import each other, and prep_utils needs pandas, tables and sklearn. Keep the two in step
+def get_compression_type(path):
+    """Returns the TFRecord compression type ('', 'GZIP' or 'ZLIB') the file at path was written with."""
+    for compression_type in ['', 'GZIP', 'ZLIB']:
+        try:
+            for _ in tf.data.TFRecordDataset(path, compression_type=compression_type).take(1):
+                pass
+            return compression_type
+        except tf.errors.DataLossError:
+            continue
+    sys.exit('{} is not a TFRecord file'.format(path))
+
+
 def ds_len(ds):
+    # known without reading ds when the loader counted its records from the shard manifests and record indexes,
+    # i.e. unless they are filtered by a bbox
+    n = int(ds.cardinality())
+    if n >= 0:
+        return n
     return len(list(ds.map(lambda x, y: 1, num_parallel_calls=tf.data.experimental.AUTOTUNE)))
 
 